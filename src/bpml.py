@@ -1,16 +1,44 @@
 import numpy as np
 
+import common
+import gpu
+from jit import NUMBA, njit, prange
 
-def make_auxiliary_fields(nx, ny):
+# "_bpml_step_uniform" is only used if at least this fraction of the cells lies in the uniform runs
+UNIFORM_FRACTION = 0.5
+
+
+def make_state(nx, ny):
     """
-    Creates fields exclusive to the Berenger PML.
+    Creates the fields ex, ey, hz and the fields hzx, hzy exclusive to the Berenger PML as views into one
+    contiguous, aligned buffer (see common.pack), so all components are allocated together.
     :param nx: int
     :param ny: int
-    :return: List[2 np.ndarrays]
+    :return: List[3 np.ndarrays], List[2 np.ndarrays]
+    """
+    ex, ey, hz, hzx, hzy = common.pack((nx, ny + 1), (nx + 1, ny), (nx, ny), (nx, ny), (nx, ny))
+    return [ex, ey, hz], [hzx, hzy]
+
+
+def _update_coefficients(material, sigma, dt, d):
+    """
+    Calculates the coefficients (2 * m - sigma * dt) / (2 * m + sigma * dt) and 2 * dt / ((2 * m + sigma * dt) * d)
+    of a lossy update equation, m being the permittivity or permeability.
+    The common denominator is computed once and inverted in place, so only three arrays are allocated.
+    :param material: np.ndarray
+    :param sigma: np.ndarray
+    :param dt: float
+    :param d: float
+    :return: np.ndarray, np.ndarray
     """
-    hzx = np.zeros((nx, ny))
-    hzy = np.zeros((nx, ny))
-    return [hzx, hzy]
+    loss = sigma * dt
+    twice = 2 * material
+    inverse = np.add(twice, loss)
+    np.reciprocal(inverse, out=inverse)
+    np.subtract(twice, loss, out=twice)
+    np.multiply(twice, inverse, out=twice)
+    np.multiply(inverse, 2 * dt / d, out=inverse)
+    return twice, inverse
 
 
 def calculate_constants(eps, mu, sigmas, dx, dy, dt):
@@ -23,53 +51,254 @@ def calculate_constants(eps, mu, sigmas, dx, dy, dt):
     :param dx: float
     :param dy: float
     :param dt: float
-    :return: List[8 np.ndarrays]
+    :return: Tuple[8 np.ndarrays]
     """
     sigmax, sigmay, sigmamx, sigmamy = sigmas
+    dx, dy, dt = common.DTYPE(dx), common.DTYPE(dy), common.DTYPE(dt)
+
+    eps_shorty = np.add(eps[:, 1:], eps[:, :-1])
+    eps_shorty *= 0.5
+    eps_shortx = np.add(eps[1:, :], eps[:-1, :])
+    eps_shortx *= 0.5
+
+    ex1, ex2 = _update_coefficients(eps_shorty, sigmay, dt, dy)
+    ey1, ey2 = _update_coefficients(eps_shortx, sigmax, dt, dx)
+    hzx1, hzx2 = _update_coefficients(mu, sigmamx, dt, dx)
+    hzy1, hzy2 = _update_coefficients(mu, sigmamy, dt, dy)
+
+    return ex1, ex2, ey1, ey2, hzx1, hzx2, hzy1, hzy2
+
+
+@njit(parallel=True, fastmath=True, cache=True, boundscheck=False)
+def _bpml_step(ex, ey, hz, hzx, hzy, ex1, ex2, ey1, ey2, hzx1, hzx2, hzy1, hzy2, sx, sy, sval):
+    """
+    Advances ex, ey, hz and the split fields hzx, hzy by one time step in place.
+    All six stencils are computed in two fused passes over the grid instead of one NumPy expression each,
+    so no temporaries are allocated. The value "sval" is written into hz at (sx, sy).
+    Both passes are split over the rows with prange: a row only writes its own cells and reads hz of itself and
+    the row before, which the first pass has completed.
+    :param ex: np.ndarray of size (nx, ny + 1)
+    :param ey: np.ndarray of size (nx + 1, ny)
+    :param hz: np.ndarray of size (nx, ny)
+    :param hzx: np.ndarray of size (nx, ny)
+    :param hzy: np.ndarray of size (nx, ny)
+    :param ex1: np.ndarray of size (nx, ny - 1)
+    :param ex2: np.ndarray of size (nx, ny - 1)
+    :param ey1: np.ndarray of size (nx - 1, ny)
+    :param ey2: np.ndarray of size (nx - 1, ny)
+    :param hzx1: np.ndarray of size (nx, ny)
+    :param hzx2: np.ndarray of size (nx, ny)
+    :param hzy1: np.ndarray of size (nx, ny)
+    :param hzy2: np.ndarray of size (nx, ny)
+    :param sx: int
+    :param sy: int
+    :param sval: float
+    """
+    nx, ny = hz.shape
+
+    for i in prange(nx):
+        for j in range(ny):
+            hzx[i, j] = hzx1[i, j] * hzx[i, j] - hzx2[i, j] * (ey[i + 1, j] - ey[i, j])
+            hzy[i, j] = hzy1[i, j] * hzy[i, j] + hzy2[i, j] * (ex[i, j + 1] - ex[i, j])
+            hz[i, j] = hzx[i, j] + hzy[i, j]
+    hz[sx, sy] = sval
+
+    for i in prange(nx):
+        for j in range(1, ny):
+            ex[i, j] = ex1[i, j - 1] * ex[i, j] + ex2[i, j - 1] * (hz[i, j] - hz[i, j - 1])
+        if i > 0:
+            for j in range(ny):
+                ey[i, j] = ey1[i - 1, j] * ey[i, j] - ey2[i - 1, j] * (hz[i, j] - hz[i - 1, j])
+
+
+def uniform_runs(constants):
+    """
+    Specializes the BPML update on the cells where the coefficients take the same values as in the center of the
+    domain, which lies outside the PML. A cell (i, j) counts as uniform if the coefficients of hz at (i, j) and those
+    of ex and ey updated in the same iteration, ex at (i, j) and ey at (i, j), match the center values.
+    For every row, the longest run of uniform cells is returned as [start, stop). Inside the run the kernel uses
+    the 8 scalar reference values instead of reading the coefficient arrays.
+    :param constants: Tuple[8 np.ndarrays]
+    :return: np.ndarray of size (nx, 2) of unsigned ints, np.ndarray of size 8
+    """
+    ex1, ex2, ey1, ey2, hzx1, hzx2, hzy1, hzy2 = constants
+    nx, ny = hzx1.shape
+    cx, cy = nx // 2, ny // 2
+    reference = np.array([ex1[cx, cy - 1], ex2[cx, cy - 1], ey1[cx - 1, cy], ey2[cx - 1, cy],
+                          hzx1[cx, cy], hzx2[cx, cy], hzy1[cx, cy], hzy2[cx, cy]], dtype=hzx1.dtype)
+
+    uniform = (hzx1 == reference[4]) & (hzx2 == reference[5]) & (hzy1 == reference[6]) & (hzy2 == reference[7])
+    uniform[:, 1:] &= (ex1 == reference[0]) & (ex2 == reference[1])
+    uniform[1:, :] &= (ey1 == reference[2]) & (ey2 == reference[3])
+
+    runs = np.zeros((nx, 2), dtype=np.uint64)
+    for i in range(nx):
+        # boundaries of the runs of True values in this row
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], uniform[i].view(np.int8), [0]))))
+        if edges.size:
+            lengths = edges[1::2] - edges[::2]
+            longest = np.argmax(lengths)
+            runs[i] = edges[2 * longest], edges[2 * longest + 1]
+    return runs, reference
 
-    eps_shorty = (eps[:, 1:] + eps[:, :-1]) / 2
-    eps_shortx = (eps[1:, :] + eps[:-1, :]) / 2
 
-    ex1 = (2 * eps_shorty - sigmay * dt) / (2 * eps_shorty + sigmay * dt)
-    ex2 = ((2 * dt) / (2 * eps_shorty + sigmay * dt)) / dy
-    ey1 = (2 * eps_shortx - sigmax * dt) / (2 * eps_shortx + sigmax * dt)
-    ey2 = ((2 * dt) / (2 * eps_shortx + sigmax * dt)) / dx
-    hzx1 = (2 * mu - sigmamx * dt) / (2 * mu + sigmamx * dt)
-    hzy1 = (2 * mu - sigmamy * dt) / (2 * mu + sigmamy * dt)
-    hzx2 = ((2 * dt) / (2 * mu + sigmamx * dt)) / dx
-    hzy2 = ((2 * dt) / (2 * mu + sigmamy * dt)) / dy
+@njit(parallel=True, fastmath=True, cache=True, boundscheck=False)
+def _bpml_step_uniform(ex, ey, hz, hzx, hzy, ex1, ex2, ey1, ey2, hzx1, hzx2, hzy1, hzy2, runs, reference,
+                       sx, sy, sval):
+    """
+    Same as "_bpml_step", but specialized at runtime on the uniform run [start, stop) of every row given by
+    "runs" (see "uniform_runs"): there the coefficients are the scalars in "reference", so only the fields have to
+    be read from memory. The coefficient arrays are only read outside of these runs.
+    The runs are iterated with unsigned indices; otherwise the possible wraparound of negative indices keeps the
+    compiler from vectorizing them.
+    :param runs: np.ndarray of size (nx, 2) of unsigned ints
+    :param reference: np.ndarray of size 8
+    """
+    nx, ny = hz.shape
+    cex1, cex2, cey1, cey2, chzx1, chzx2, chzy1, chzy2 = reference
+    one, nyu = np.uint64(1), np.uint64(ny)
+
+    for i in prange(nx):
+        start, stop = runs[i, 0], runs[i, 1]
+        for j in range(start):
+            hzx[i, j] = hzx1[i, j] * hzx[i, j] - hzx2[i, j] * (ey[i + 1, j] - ey[i, j])
+            hzy[i, j] = hzy1[i, j] * hzy[i, j] + hzy2[i, j] * (ex[i, j + one] - ex[i, j])
+            hz[i, j] = hzx[i, j] + hzy[i, j]
+        for j in range(start, stop):
+            hzx[i, j] = chzx1 * hzx[i, j] - chzx2 * (ey[i + 1, j] - ey[i, j])
+            hzy[i, j] = chzy1 * hzy[i, j] + chzy2 * (ex[i, j + one] - ex[i, j])
+            hz[i, j] = hzx[i, j] + hzy[i, j]
+        for j in range(stop, nyu):
+            hzx[i, j] = hzx1[i, j] * hzx[i, j] - hzx2[i, j] * (ey[i + 1, j] - ey[i, j])
+            hzy[i, j] = hzy1[i, j] * hzy[i, j] + hzy2[i, j] * (ex[i, j + one] - ex[i, j])
+            hz[i, j] = hzx[i, j] + hzy[i, j]
+    hz[sx, sy] = sval
 
-    return [ex1, ex2, ey1, ey2, hzx1, hzx2, hzy1, hzy2]
+    for i in prange(nx):
+        start, stop = max(runs[i, 0], one), max(runs[i, 1], one)
+        for j in range(one, start):
+            ex[i, j] = ex1[i, j - one] * ex[i, j] + ex2[i, j - one] * (hz[i, j] - hz[i, j - one])
+        for j in range(start, stop):
+            ex[i, j] = cex1 * ex[i, j] + cex2 * (hz[i, j] - hz[i, j - one])
+        for j in range(stop, nyu):
+            ex[i, j] = ex1[i, j - one] * ex[i, j] + ex2[i, j - one] * (hz[i, j] - hz[i, j - one])
 
+        if i > 0:
+            start, stop = runs[i, 0], runs[i, 1]
+            for j in range(start):
+                ey[i, j] = ey1[i - 1, j] * ey[i, j] - ey2[i - 1, j] * (hz[i, j] - hz[i - 1, j])
+            for j in range(start, stop):
+                ey[i, j] = cey1 * ey[i, j] - cey2 * (hz[i, j] - hz[i - 1, j])
+            for j in range(stop, nyu):
+                ey[i, j] = ey1[i - 1, j] * ey[i, j] - ey2[i - 1, j] * (hz[i, j] - hz[i - 1, j])
 
-def evolution(nt, fields, aux_fields, constants, history, sourcepoint, source):
+
+def _numpy_step(fields, aux_fields, constants, scratch, sourcepoint, sval, xp=np):
+    """
+    Advances ex, ey, hz and the split fields hzx, hzy by one time step in place using array expressions.
+    :param fields: List[3 np.ndarrays]
+    :param aux_fields: List[2 np.ndarrays]
+    :param constants: Tuple[8 np.ndarrays]
+    :param scratch: List[4 np.ndarrays]
+    :param sourcepoint: Tuple(int, int)
+    :param sval: float
+    :param xp: module, numpy or cupy
     """
-    Calculate the behavior of the situation determined by the "constants" and "aux_constants".
-    A source determined by the function "source" excites the field at point "sourcepoint".
+    ex, ey, hz = fields
+    hzx, hzy = aux_fields
+    ex1, ex2, ey1, ey2, hzx1, hzx2, hzy1, hzy2 = constants
+    diff_x, diff_y, diff_hx, diff_hy = scratch
+
+    xp.subtract(ey[1:, :], ey[:-1, :], out=diff_x)
+    xp.multiply(hzx2, diff_x, out=diff_x)
+    hzx *= hzx1
+    hzx -= diff_x
+    xp.subtract(ex[:, 1:], ex[:, :-1], out=diff_y)
+    xp.multiply(hzy2, diff_y, out=diff_y)
+    hzy *= hzy1
+    hzy += diff_y
+    xp.add(hzx, hzy, out=hz)
+    hz[sourcepoint] = sval
+
+    xp.subtract(hz[:, 1:], hz[:, :-1], out=diff_hy)
+    xp.multiply(ex2, diff_hy, out=diff_hy)
+    ex[:, 1:-1] *= ex1
+    ex[:, 1:-1] += diff_hy
+    xp.subtract(hz[1:, :], hz[:-1, :], out=diff_hx)
+    xp.multiply(ey2, diff_hx, out=diff_hx)
+    ey[1:-1, :] *= ey1
+    ey[1:-1, :] -= diff_hx
+
+
+def evolution(nt, fields, aux_fields, constants, history, sourcepoint, source_vals):
+    """
+    Calculate the behavior of the situation determined by the "constants".
+    The source excites the field at point "sourcepoint" with the value "source_vals[t]" at time step t.
     The value of "hz" at each timestep is stored in "history" which is then returned.
     :param nt: int
     :param fields: List[3 np.ndarrays]
-    :param aux_fields: List[4 np.ndarrays]
-    :param constants: List[7 np.ndarrays]
-    :param aux_constants: List[8 np.ndarrays]
-    :param history: np.ndarray of size [nx, ny, nt]
-    :param sourcepoint: Tuple(float, float)
-    :param source: function
-    :return: np.ndarray of size [nx, ny, nt]
+    :param aux_fields: List[2 np.ndarrays], the split fields hzx and hzy
+    :param constants: Tuple[8 np.ndarrays]
+    :param history: np.ndarray of size [nt, nx, ny], or None to only keep the final hz
+    :param sourcepoint: Tuple(int, int), negative indices count from the end
+    :param source_vals: np.ndarray of size nt
+    :return: np.ndarray of size [nt, nx, ny], or hz of size [nx, ny] if "history" is None
     """
     ex, ey, hz = fields
+    sourcepoint = common.grid_index(sourcepoint, hz.shape)
     hzx, hzy = aux_fields
     ex1, ex2, ey1, ey2, hzx1, hzx2, hzy1, hzy2 = constants
+    record = history is not None
+
+    if NUMBA:
+        sx, sy = sourcepoint
+        runs, reference = uniform_runs(constants)
+        if np.sum(runs[:, 1] - runs[:, 0]) >= UNIFORM_FRACTION * hz.size:
+            for t in range(nt):
+                _bpml_step_uniform(ex, ey, hz, hzx, hzy, ex1, ex2, ey1, ey2, hzx1, hzx2, hzy1, hzy2, runs, reference,
+                                   sx, sy, source_vals[t])
+                if record:
+                    np.copyto(history[t], hz)
+            return history if record else hz
 
+        for t in range(nt):
+            _bpml_step(ex, ey, hz, hzx, hzy, ex1, ex2, ey1, ey2, hzx1, hzx2, hzy1, hzy2, sx, sy, source_vals[t])
+            if record:
+                np.copyto(history[t], hz)
+        return history if record else hz
+
+    scratch = common.make_scratch(hz)
     for t in range(nt):
-        hzx = hzx1 * hzx - hzx2 * (ey[1:, :] - ey[:-1, :])
-        hzy = hzy1 * hzy + hzy2 * (ex[:, 1:] - ex[:, :-1])
-        hz = hzx + hzy
-        hz[sourcepoint] = source(t)
+        _numpy_step(fields, aux_fields, constants, scratch, sourcepoint, source_vals[t])
+        if record:
+            np.copyto(history[t], hz)
+
+    return history if record else hz
+
+
+def gpu_evolution(nt, fields, aux_fields, constants, history, sourcepoint, source_vals, chunk=32):
+    """
+    Same as "evolution", but runs the array implementation of the time step on the GPU using CuPy.
+    Fields and constants are copied to the device once; "gpu.run" streams the values of "hz" back into "history".
+    :param nt: int
+    :param fields: List[3 np.ndarrays]
+    :param aux_fields: List[2 np.ndarrays]
+    :param constants: Tuple[8 np.ndarrays]
+    :param history: np.ndarray of size [nt, nx, ny], or None to only keep the final hz
+    :param sourcepoint: Tuple(int, int), negative indices count from the end
+    :param source_vals: np.ndarray of size nt
+    :param chunk: int
+    :return: np.ndarray of size [nt, nx, ny], or hz of size [nx, ny] if "history" is None
+    """
+    import cupy as cp
 
-        ex[:, 1:-1] = ex1 * ex[:, 1:-1] + ex2 * (hz[:, 1:] - hz[:, :-1])
-        ey[1:-1, :] = ey1 * ey[1:-1, :] - ey2 * (hz[1:, :] - hz[:-1, :])
+    sourcepoint = common.grid_index(sourcepoint, fields[2].shape)
+    fields = [cp.asarray(field) for field in fields]
+    aux_fields = [cp.asarray(field) for field in aux_fields]
+    constants = [cp.asarray(constant) for constant in constants]
+    scratch = common.make_scratch(fields[2], cp)
 
-        history[:, :, t] = hz
+    def step(t):
+        _numpy_step(fields, aux_fields, constants, scratch, sourcepoint, source_vals[t], cp)
 
-    return history
+    return gpu.run(nt, step, fields[2], history, chunk)
@@ -4,28 +4,43 @@ import bpml
 import common
 import cpml
 import no_pml
+import source as src
 
+BACKENDS = ("cpu", "gpu")
 
-def call_common(nx, ny, nt, dx, dy, pmlc):
+
+def check_backend(backend):
+    """
+    Raises a ValueError for anything but the backends "cpu" and "gpu", so a misspelled backend does not silently
+    run on the CPU.
+    :param backend: string
+    """
+    if backend not in BACKENDS:
+        raise ValueError("unknown backend %r, expected one of %s" % (backend, ", ".join(BACKENDS)))
+
+
+def call_common(nx, ny, nt, dx, dy, pmlc, history_path=None, record=True):
     """
-    Creates fields that are common to all implementations according to the given arguments
+    Creates the environment and the history that are common to the implementations with a PML according to the given
+    arguments. The fields are left to the callers, as the Berenger PML allocates them together with its split fields.
     :param nx: int
     :param ny: int
     :param nt: int
     :param dx: float
     :param dy: float
     :param pmlc: Tuple(float, float, float)
-    :return:
+    :param history_path: string
+    :param record: bool, if False no history is created
+    :return: np.ndarray, np.ndarray, List[4 np.ndarrays], np.ndarray or None
     """
-    fields = common.make_fields(nx, ny)
     eps, mu = common.make_env(nx, ny)
     sigmas = common.make_sigmas(nx, ny)
     sigmas = common.pml(sigmas, pmlc, dx, dy)
-    history = np.zeros((nx, ny, nt))
-    return fields, eps, mu, sigmas, history
+    history = common.make_history(nx, ny, nt, history_path) if record else None
+    return eps, mu, sigmas, history
 
 
-def call_npml(nx, ny, nt, dx, dy, dt, p, source):
+def call_npml(nx, ny, nt, dx, dy, dt, p, source, history_path=None, backend="cpu", record=True, probe_points=None):
     """
     Calls a simulation without a PML according to the given arguments.
     :param nx: int
@@ -35,16 +50,28 @@ def call_npml(nx, ny, nt, dx, dy, dt, p, source):
     :param dy: float
     :param dt: float
     :param p: Tuple(float, float)
-    :param source: function
-    :return: np.ndarray of size (nx, ny, nt)
+    :param source: function or np.ndarray of size nt
+    :param history_path: string
+    :param backend: string, "cpu" or "gpu"
+    :param record: bool, if False only the final hz of size (nx, ny) is returned
+    :param probe_points: List[Tuple(int, int)], if given only the values of hz at these points are recorded and
+                         returned as an np.ndarray of size (len(probe_points), nt)
+    :return: np.ndarray of size (nt, nx, ny)
     """
+    check_backend(backend)
+    record = record and probe_points is None
     fields = common.make_fields(nx, ny)
     constants = no_pml.calculate_constants(dx, dy, dt)
-    history = np.zeros((nx, ny, nt))
-    return no_pml.evolution(nt, fields, constants, history, p, source)
+    # the null source leaves the fields at zero, so it is not applied at all
+    source_vals = None if source is src.null_source else src.source_values(source, nt)
+    history = common.make_history(nx, ny, nt, history_path) if record else None
 
+    if backend == "gpu":
+        return no_pml.gpu_evolution(nt, fields, constants, history, p, source_vals, probe_points=probe_points)
+    return no_pml.evolution(nt, fields, constants, history, p, source_vals, probe_points)
 
-def call_bpml(nx, ny, nt, dx, dy, dt, p, pmlc, source, s=0):
+
+def call_bpml(nx, ny, nt, dx, dy, dt, p, pmlc, source, s=0, history_path=None, backend="cpu", record=True):
     """
     Calls a simulation with a berenger PML according to the given arguments.
     :param nx: int
@@ -55,24 +82,35 @@ def call_bpml(nx, ny, nt, dx, dy, dt, p, pmlc, source, s=0):
     :param dt: float
     :param p: Tuple(float, float)
     :param pmlc: Tuple(float, float, float)
-    :param source: function
+    :param source: function or np.ndarray of size nt
     :param s: float
-    :return: np.ndarray of size (nx, ny, nt)
+    :param history_path: string
+    :param backend: string, "cpu" or "gpu"
+    :param record: bool, if False only the final hz of size (nx, ny) is returned
+    :return: np.ndarray of size (nt, nx, ny)
     """
-    fields, eps, mu, sigmas, history = call_common(nx, ny, nt, dx, dy, pmlc)
+    check_backend(backend)
+    eps, mu, sigmas, history = call_common(nx, ny, nt, dx, dy, pmlc, history_path, record)
+    fields, aux_fields = bpml.make_state(nx, ny)
 
     sigmas = common.add_loss(sigmas, 10, s)
-    sigmas[2] *= mu / eps
-    sigmas[3] *= mu / eps
+    # magnetic conductivities matching the electric ones, mu / eps is computed once for both
+    ratio = np.reciprocal(eps)
+    ratio *= mu
+    sigmas[2] *= ratio
+    sigmas[3] *= ratio
     eps, mu, sigmas = common.environment_problem_example(eps, mu, sigmas, dx, dy)
 
-    aux_fields = bpml.make_auxiliary_fields(nx, ny)
     constants = bpml.calculate_constants(eps, mu, sigmas, dx, dy, dt)
+    source_vals = src.source_values(source, nt)
 
-    return bpml.evolution(nt, fields, aux_fields, constants, history, p, source)
+    if backend == "gpu":
+        return bpml.gpu_evolution(nt, fields, aux_fields, constants, history, p, source_vals)
+    return bpml.evolution(nt, fields, aux_fields, constants, history, p, source_vals)
 
 
-def call_cpml(nx, ny, nt, dx, dy, dt, p, pmlc, source):
+def call_cpml(nx, ny, nt, dx, dy, dt, p, pmlc, source, history_path=None, backend="cpu", record=True,
+              probe_points=None):
     """
     Calls a simulation with a convolutional PML according to the given arguments.
     :param nx: int
@@ -83,16 +121,28 @@ def call_cpml(nx, ny, nt, dx, dy, dt, p, pmlc, source):
     :param dt: float
     :param p: Tuple(float, float)
     :param pmlc: Tuple(float, float, float)
-    :param source: function
-    :return: np.ndarray of size (nx, ny, nt)
+    :param source: function or np.ndarray of size nt
+    :param history_path: string
+    :param backend: string, "cpu" or "gpu"
+    :param record: bool, if False only the final hz of size (nx, ny) is returned
+    :param probe_points: List[Tuple(int, int)], if given only the values of hz at these points are recorded and
+                         returned as an np.ndarray of size (len(probe_points), nt)
+    :return: np.ndarray of size (nt, nx, ny)
     """
-    fields, eps, mu, sigmas, history = call_common(nx, ny, nt, dx, dy, pmlc)
+    check_backend(backend)
+    record = record and probe_points is None
+    eps, mu, sigmas, history = call_common(nx, ny, nt, dx, dy, pmlc, history_path, record)
+    fields = common.make_fields(nx, ny)
 
     eps, mu, sigmas = common.environment_problem_example(eps, mu, sigmas, dx, dy)
     #eps, mu, sigmas = common.modify_env(eps, mu, sigmas)
 
     aux_fields = cpml.make_auxiliary_fields(nx, ny)
     constants = cpml.calculate_constants(eps, mu, dx, dy, dt)
-    aux_constants = cpml.cpml_constants(nx, ny, sigmas, dx, dy, dt)
+    aux_constants = cpml.cpml_constants(nx, ny, sigmas, dx, dy, dt, pmlc[0])
+    source_vals = src.source_values(source, nt)
 
-    return cpml.evolution(nt, fields, aux_fields, constants, aux_constants, history, p, source)
+    if backend == "gpu":
+        return cpml.gpu_evolution(nt, fields, aux_fields, constants, aux_constants, history, p, source_vals,
+                                  probe_points=probe_points)
+    return cpml.evolution(nt, fields, aux_fields, constants, aux_constants, history, p, source_vals, probe_points)
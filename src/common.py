@@ -1,4 +1,7 @@
+import functools
+import gc
 import math
+import time
 
 import matplotlib.animation as anim
 import matplotlib.colors as colors
@@ -7,32 +10,126 @@ import numpy as np
 import scipy.constants as const
 from typing import *
 
+from jit import NUMBA, njit
+
+DTYPE = np.float32  # floating point type of all fields, material parameters and constants
+ALIGNMENT = 64  # in bytes, packed field arrays start at addresses that are a multiple of this
+
+
+def padded(n):
+    """
+    Rounds the number of elements "n" up so that n DTYPE values fill a whole multiple of ALIGNMENT bytes.
+    :param n: int
+    :return: int
+    """
+    lanes = ALIGNMENT // np.dtype(DTYPE).itemsize
+    return -(-n // lanes) * lanes
+
+
+def pack(*shapes):
+    """
+    Allocates one contiguous, zeroed buffer for arrays of the given shapes and returns them as views into it.
+    Every view is itself C-contiguous, so the kernels can treat it as a plain 2d array, and starts at an address that
+    is a multiple of ALIGNMENT bytes. The rows themselves are not padded, as the compiled time steps rely on the
+    arrays being contiguous.
+    :param shapes: Tuple(int, int)
+    :return: List[np.ndarrays]
+    """
+    sizes = [shape[0] * shape[1] for shape in shapes]
+    offsets = np.cumsum([0] + [padded(size) for size in sizes])
+    # numpy only guarantees a smaller alignment, so allocate one extra block and skip to the first aligned address
+    itemsize = np.dtype(DTYPE).itemsize
+    buffer = np.zeros(offsets[-1] + ALIGNMENT // itemsize, dtype=DTYPE)
+    start = (-buffer.ctypes.data % ALIGNMENT) // itemsize
+    buffer = buffer[start:start + offsets[-1]]
+    return [buffer[o:o + size].reshape(shape) for o, size, shape in zip(offsets, sizes, shapes)]
+
 
 def make_fields(nx, ny):
     """
-    Creates the fields Ex, Ey and Hz required for every simulation as numpy arrays of desired size
+    Creates the fields Ex, Ey and Hz required for every simulation as numpy arrays of desired size.
+    The three are views into one contiguous buffer (see "pack").
     :param nx: int
     :param ny: int
     :return: List[np.ndrarray, np.ndarray, np.ndarray]
     """
-    ex = np.zeros((nx, ny + 1))
-    ey = np.zeros((nx + 1, ny))
-    hz = np.zeros((nx, ny))
-    return [ex, ey, hz]
+    return pack((nx, ny + 1), (nx + 1, ny), (nx, ny))
 
 
 def make_sigmas(nx, ny):
     """
-    Creates the empty numpy arrays containing the electric and magnetic conductivities
+    Creates the empty numpy arrays containing the electric and magnetic conductivities.
+    All four are views into one contiguous buffer (see "pack"), so they must be modified in place.
     :param nx: int
     :param ny: int
     :return: List[np.ndrarray, np.ndarray, np.ndarray, np.ndarray]
     """
-    sigmax = np.zeros((nx - 1, ny))
-    sigmay = np.zeros((nx, ny - 1))
-    sigmamx = np.zeros((nx, ny))
-    sigmamy = np.zeros((nx, ny))
-    return [sigmax, sigmay, sigmamx, sigmamy]
+    return pack((nx - 1, ny), (nx, ny - 1), (nx, ny), (nx, ny))
+
+
+def make_history(nx, ny, nt, history_path=None):
+    """
+    Creates the array in which the value of hz at every time step is stored.
+    If "history_path" is given, the array is a memory mapped .npy file at that location instead of residing in memory,
+    so only the pages currently written have to be kept in RAM.
+    The in-memory array is left uninitialized, as the evolutions write every time step in order; this way its pages
+    are only touched once, by those writes.
+    :param nx: int
+    :param ny: int
+    :param nt: int
+    :param history_path: string
+    :return: np.ndarray of size (nt, nx, ny)
+    """
+    if history_path is not None:
+        return np.lib.format.open_memmap(history_path, mode='w+', dtype=DTYPE, shape=(nt, nx, ny))
+    return np.empty((nt, nx, ny), dtype=DTYPE)
+
+
+def make_scratch(hz, xp=np):
+    """
+    Creates the buffers for the spatial differences of ey, ex and hz used by the array implementations of the time
+    step, so the steps can work in place. With xp set to cupy, the buffers reside on the GPU.
+    :param hz: np.ndarray of size (nx, ny)
+    :param xp: module, numpy or cupy
+    :return: List[4 np.ndarrays]
+    """
+    nx, ny = hz.shape
+    diff_x = xp.empty((nx, ny), dtype=hz.dtype)
+    diff_y = xp.empty((nx, ny), dtype=hz.dtype)
+    diff_hx = xp.empty((nx - 1, ny), dtype=hz.dtype)
+    diff_hy = xp.empty((nx, ny - 1), dtype=hz.dtype)
+    return [diff_x, diff_y, diff_hx, diff_hy]
+
+
+def grid_index(point, shape):
+    """
+    Converts the point (x, y) into non-negative indices of an array of size "shape". Negative indices count from the
+    end, as in NumPy, so every implementation of the time step addresses the same cell.
+    :param point: Tuple(int, int)
+    :param shape: Tuple(int, int)
+    :return: Tuple(int, int)
+    """
+    x, y = point
+    nx, ny = shape
+    if not (-nx <= x < nx and -ny <= y < ny):
+        raise ValueError("point %s lies outside of the grid of size %s" % ((x, y), (nx, ny)))
+    return x % nx, y % ny
+
+
+def make_probes(probe_points, nt, shape):
+    """
+    Creates the array in which the value of hz at each of the "probe_points" is stored at every time step, along with
+    the x and the y indices of the points, with negative indices wrapped as in "grid_index". Without probe points,
+    all three arrays are empty.
+    :param probe_points: List[Tuple(int, int)] or None
+    :param nt: int
+    :param shape: Tuple(int, int), the shape of hz
+    :return: np.ndarray of size (len(probe_points), nt), np.ndarray, np.ndarray
+    """
+    points = [grid_index(point, shape) for point in ([] if probe_points is None else probe_points)]
+    points = np.array(points, dtype=np.intp).reshape(-1, 2)
+    probes = np.empty((len(points), nt), dtype=DTYPE)
+    return probes, np.ascontiguousarray(points[:, 0]), np.ascontiguousarray(points[:, 1])
 
 
 def luneberg(eps, mx, my, R):
@@ -47,12 +144,10 @@ def luneberg(eps, mx, my, R):
     :return: np.ndarray
     """
 
-    for qx in range(mx - R, mx + R):
-        for qy in range(my - R, my + R):
-            r = int(math.sqrt((qx - mx) ** 2 + (qy - my) ** 2))
-            if r > R:
-                continue
-            eps[qx, qy] *= 2 - (r / R) ** 2
+    qx, qy = np.ogrid[mx - R:mx + R, my - R:my + R]
+    r = np.sqrt((qx - mx) ** 2 + (qy - my) ** 2).astype(int)
+    mask = r <= R
+    eps[mx - R:mx + R, my - R:my + R][mask] *= 2 - (r[mask] / R) ** 2
 
     return eps
 
@@ -70,16 +165,30 @@ def add_loss(sigmas, w, s):
     return sigmas
 
 
+@functools.lru_cache(maxsize=8)
+def _vacuum_mu(nx, ny):
+    """
+    The permeability of a vacuum, filled once for each of the last few grid sizes. It is never modified by the
+    simulations, so the cached array is read-only.
+    :param nx: int
+    :param ny: int
+    :return: np.ndarray
+    """
+    mu = np.full((nx, ny), const.mu_0, dtype=DTYPE)
+    mu.setflags(write=False)
+    return mu
+
+
 def make_env(nx, ny):
     """
-    Creates
+    Creates the permittivity and the permeability of a vacuum.
+    The permittivity is a new array, as the environments modify it in place; the permeability is shared and
+    read-only, see "_vacuum_mu".
     :param nx: int
     :param ny: int
     :return: np.ndarray, np.ndarray
     """
-    eps = np.ones((nx, ny)) * const.epsilon_0
-    mu = np.ones((nx, ny)) * const.mu_0
-    return eps, mu
+    return np.full((nx, ny), const.epsilon_0, dtype=DTYPE), _vacuum_mu(nx, ny)
 
 
 def pml(sigmas, pmlc, dx, dy):
@@ -93,30 +202,52 @@ def pml(sigmas, pmlc, dx, dy):
     """
     w, r0, m = pmlc
     delta = np.sqrt((dx ** 2 + dy ** 2) / 2)
-    sigmamax = -math.log(r0) * (m + 1) * const.epsilon_0 * const.c / (2 * w * delta)
+    sigmamax = DTYPE(-math.log(r0) * (m + 1) * const.epsilon_0 * const.c / (2 * w * delta))
     wp = w + 1
-    for q in range(w):
-        sigmas[0][q, :] = wp - 0.5 - q
-        sigmas[0][-q - 1, :] = wp - 0.5 - q
-        sigmas[1][:, q] = wp - 0.5 - q
-        sigmas[1][:, -q - 1] = wp - 0.5 - q
-        sigmas[2][q, :] = wp - q
-        sigmas[2][-q - 1, :] = wp - q
-        sigmas[3][:, q] = wp - q
-        sigmas[3][:, -q - 1] = wp - q
-    sigmas[0] = sigmamax * (sigmas[0] / w) ** m
-    sigmas[1] = sigmamax * (sigmas[1] / w) ** m
-    sigmas[2] = sigmamax * (sigmas[2] / w) ** m
-    sigmas[3] = sigmamax * (sigmas[3] / w) ** m
+    # graded profiles of the w boundary cells, only these are written into the otherwise zero arrays
+    r_edge = sigmamax * ((wp - 0.5 - np.arange(w)) / w) ** m  # grading at the positions of ex and ey
+    r_face = sigmamax * ((wp - np.arange(w)) / w) ** m  # grading at the positions of hz
+    sigmas[0][:w, :] = r_edge[:, None]
+    sigmas[0][-w:, :] = r_edge[::-1, None]
+    sigmas[1][:, :w] = r_edge[None, :]
+    sigmas[1][:, -w:] = r_edge[None, ::-1]
+    sigmas[2][:w, :] = r_face[:, None]
+    sigmas[2][-w:, :] = r_face[::-1, None]
+    sigmas[3][:, :w] = r_face[None, :]
+    sigmas[3][:, -w:] = r_face[None, ::-1]
     return sigmas
 
 
+@njit(cache=True)
+def _modes(values):
+    """
+    Minimum, mean and standard deviation of the flat array "values" in a single pass, using Welford's update of
+    the mean and the sum of squared deviations.
+    :param values: np.ndarray of size n
+    :return: Tuple(float, float, float)
+    """
+    minimum = values[0]
+    mean = 0.0
+    squares = 0.0
+    for n in range(values.size):
+        value = values[n]
+        minimum = min(minimum, value)
+        delta = value - mean
+        mean += delta / (n + 1)
+        squares += delta * (value - mean)
+    return minimum, mean, math.sqrt(squares / values.size)
+
+
 def get_modes(data):
     """
     Calculate minimum, mean and standard deviation of the given data.
+    With numba this takes a single pass over the data instead of three.
     :param data: np.ndarray
     :return: List[float, float, float]
     """
+    # "_modes" reads the first value unchecked; empty data is left to np.min, which raises a ValueError
+    if NUMBA and np.size(data) > 0:
+        return list(_modes(np.ravel(data)))
     return [np.min(data), np.mean(data), np.std(data)]
 
 
@@ -139,24 +270,50 @@ def add_loss_half(sigmas):
     :param sigmas: List[4 np.ndarrays]
     :return:
     """
-    y = int(sigmas[0].shape[1] / 2)
+    y = sigmas[0].shape[1] // 2
     sigmas[0][:, y:] = 0.01
     sigmas[1][:, y:] = 0.01
 
     return sigmas
 
 
+def bench(function, rep=100, num=1):
+    """
+    Times "rep" samples of "num" calls of "function" each, like timeit.repeat, but reads time.perf_counter_ns
+    directly. One untimed call before the samples absorbs the numba compilation and the first page faults, and the
+    garbage collector is disabled while sampling.
+    :param function: function
+    :param rep: int
+    :param num: int
+    :return: List[float] of seconds per sample
+    """
+    function()
+    times = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rep):
+            start = time.perf_counter_ns()
+            for _ in range(num):
+                function()
+            times.append((time.perf_counter_ns() - start) / 1e9)
+    finally:
+        if enabled:
+            gc.enable()
+    return times
+
+
 def compare(data_sets: List):
     """
     Receive a list of multiple numpy arrays. Compute their min, mean and std using function get_modes()
     Use minimum of first numpy array as base case. Represent all results as multiples of this base case.
     Return the result
     :param data_sets: List[np.ndarray]
-    :return:
+    :return: np.ndarray of size (len(data_sets), 3)
     """
-    base_case = np.min(data_sets[0])
-    results = [get_modes(data) / base_case for data in data_sets]
-    return results
+    modes = np.array([get_modes(data) for data in data_sets])
+    # the minimum of the first data set is already part of its modes
+    return modes / modes[0, 0]
 
 
 def modify_env(eps, mu, sigmas):
@@ -184,23 +341,20 @@ def environment_problem_example(eps, mu, sigmas, dx, dy):
 
     plate_x1, plate_y1 = meters_to_points(2.1, 1.1, dx, dy)
     plate_x2, plate_y2 = meters_to_points(1.1, 2.1, dx, dy)
-    qx = plate_x1 - plate_x2
-    for i in range(0, qx):
-        sigmas[2][plate_x2 + i, plate_y2 - i] = 1e9
-        sigmas[3][plate_x2 + i, plate_y2 - i] = 1e9
+    diagonal = np.arange(plate_x1 - plate_x2)
+    sigmas[2][plate_x2 + diagonal, plate_y2 - diagonal] = 1e9
+    sigmas[3][plate_x2 + diagonal, plate_y2 - diagonal] = 1e9
 
     bx, by = meters_to_points(1.6, 4.1, dx, dy)
     rx, ry = meters_to_points(0.5, 0.5, dx, dy)
     radius = int(np.sqrt(rx ** 2 / 2 + ry ** 2 / 2))
 
-    for qx in range(bx - rx, bx + rx):
-        for qy in range(by - ry, by + ry):
-            r = int(math.sqrt((qx - bx) ** 2 + (qy - by) ** 2))
-            if r > radius:
-                continue
-            sigmas[2][qx, qy] = 0.01
-            sigmas[3][qx, qy] = 0.01
-            eps[qx, qy] *= 4
+    qx, qy = np.ogrid[bx - rx:bx + rx, by - ry:by + ry]
+    mask = np.sqrt((qx - bx) ** 2 + (qy - by) ** 2).astype(int) <= radius
+    disc = (slice(bx - rx, bx + rx), slice(by - ry, by + ry))
+    sigmas[2][disc][mask] = 0.01
+    sigmas[3][disc][mask] = 0.01
+    eps[disc][mask] *= 4
 
     return eps, mu, sigmas
 
@@ -208,18 +362,23 @@ def environment_problem_example(eps, mu, sigmas, dx, dy):
 def plot_2d(data, nt):
     """
     Plot an animated color plot of the received data "data" for "nt" time steps
-    :param data: np.ndarray[nx, ny, nt]
+    The absolute value is taken frame by frame into one reused buffer, so no second array of the size of "data"
+    is created. This keeps memory mapped histories out of RAM.
+    :param data: np.ndarray[nt, nx, ny]
     :param nt: int
     """
     plt.style.use('classic')
     maxval = np.max(data)
     print("maxval: ", maxval)
+    frame = np.abs(data[0])
     fig = plt.figure()
-    ims = []
-    for i in range(nt):
-        im = plt.imshow(np.fabs(data[:, :, i]), norm=colors.Normalize(0.0, maxval))
-        ims.append([im])
-    animation = anim.ArtistAnimation(fig, ims, interval=50)
+    im = plt.imshow(frame, norm=colors.Normalize(0.0, maxval), animated=True)
+
+    def update(i):
+        im.set_data(np.abs(data[i], out=frame))
+        return [im]
+
+    animation = anim.FuncAnimation(fig, update, frames=nt, interval=50, blit=True)
     plt.show()
 
 
@@ -1,6 +1,24 @@
+import ctypes
+from collections import namedtuple
+
 import numpy as np
 import scipy.constants as const
 
+import common
+import gpu
+from jit import C_ARRAY, NUMBA, get_num_threads, load_c_function, njit, prange
+
+# the constants of the update equations of ex, ey and hz, and those of pex, pey, phx and phy
+CpmlConstants = namedtuple("CpmlConstants", "cex cey chx chy px py pm")
+CpmlAuxConstants = namedtuple("CpmlAuxConstants", "aex aey ahx ahy bex bey bhx bhy")
+
+# number of time steps advanced per sweep of "_cpml_wavefront"
+TIME_BLOCK = 8
+
+# time step compiled from "cpml_step.c", used instead of the NumPy implementation when numba is not installed
+_c_step = load_c_function("libcpml_step.so", "cpml_step",
+                          [ctypes.c_int] * 2 + [C_ARRAY] * 22 + [ctypes.c_int] * 2 + [ctypes.c_float], common.DTYPE)
+
 
 def make_auxiliary_fields(nx, ny):
     """
@@ -9,10 +27,10 @@ def make_auxiliary_fields(nx, ny):
     :param ny: int
     :return: List[4 np.ndarrays]
     """
-    pex = np.zeros((nx - 1, ny))
-    pey = np.zeros((nx, ny - 1))
-    phx = np.zeros((nx, ny))
-    phy = np.zeros((nx, ny))
+    pex = np.zeros((nx - 1, ny), dtype=common.DTYPE)
+    pey = np.zeros((nx, ny - 1), dtype=common.DTYPE)
+    phx = np.zeros((nx, ny), dtype=common.DTYPE)
+    phy = np.zeros((nx, ny), dtype=common.DTYPE)
     return pex, pey, phx, phy
 
 
@@ -25,101 +43,353 @@ def calculate_constants(eps, mu, dx, dy, dt):
     :param dx: float
     :param dy: float
     :param dt: float
-    :return: List[7 np.ndarrays]
+    :return: CpmlConstants of 7 np.ndarrays
     """
     kx = 1
     ky = 1
+    dx, dy, dt = common.DTYPE(dx), common.DTYPE(dy), common.DTYPE(dt)
+
+    # dt / eps averaged onto the positions of ex and ey, built from the reciprocal of eps without temporaries
+    inverse_eps = np.reciprocal(eps)
+    px = np.add(inverse_eps[:, 1:], inverse_eps[:, :-1])
+    px *= dt / 2
+    py = np.add(inverse_eps[1:, :], inverse_eps[:-1, :])
+    py *= dt / 2
+    pm = np.reciprocal(mu)
+    pm *= dt
 
-    cex = dt / (ky*dy*eps)
-    cey = dt / (kx*dx*eps)
-    chx = dt / (ky*dy*mu)
-    chy = dt / (kx*dx*mu)
-    cex = (cex[:, 1:] + cex[:, :-1]) / 2
-    cey = (cey[1:, :] + cey[:-1, :]) / 2
+    cex = np.multiply(px, 1 / (ky*dy))
+    cey = np.multiply(py, 1 / (kx*dx))
+    chx = np.multiply(pm, 1 / (ky*dy))
+    chy = np.multiply(pm, 1 / (kx*dx))
 
-    pe = dt / eps
-    pm = dt / mu
-    px = (pe[:, 1:] + pe[:, :-1]) / 2
-    py = (pe[1:, :] + pe[:-1, :]) / 2
+    return CpmlConstants(cex, cey, chx, chy, px, py, pm)
 
-    return [cex, cey, chx, chy, px, py, pm]
+
+def _decay_factor(sigma, alpha, k, decay):
+    """
+    Computes exp(-sigma / (k + alpha) * decay) with a single division, reusing "alpha" as the result buffer.
+    :param sigma: np.ndarray
+    :param alpha: np.ndarray of the same size, overwritten
+    :param k: float
+    :param decay: float, dt / epsilon_0
+    :return: np.ndarray, "alpha"
+    """
+    alpha += k
+    np.reciprocal(alpha, out=alpha)
+    alpha *= -decay
+    alpha *= sigma
+    return np.exp(alpha, out=alpha)
 
 
-def cpml_constants(nx, ny, sigmas, dx, dy, dt):
+def cpml_constants(nx, ny, sigmas, dx, dy, dt, w=10):
     """
     Calculate the constants used in the update equations of pex, pey, phx, phy
     These constants depend on epsilon, mu and sigma and completely describe the environment.
+    The frequency shift alpha rises linearly over the "w" cells of the PML, from 1 / w at the boundary to 1.
     :param nx: int
     :param ny: int
     :param sigmas: List[4 np.ndarrays]
     :param dx: float
     :param dy: float
     :param dt: float
-    :return: List[8 np.ndarrays]
+    :param w: int, thickness of the PML
+    :return: CpmlAuxConstants of 8 np.ndarrays
     """
     k = 1
+    dx, dy = common.DTYPE(dx), common.DTYPE(dy)
+    decay = common.DTYPE(dt / const.epsilon_0)
+
+    alpha_x = np.ones((nx-1, ny), dtype=common.DTYPE)
+    alpha_y = np.ones((nx, ny-1), dtype=common.DTYPE)
+    alpha_mx = np.ones((nx, ny), dtype=common.DTYPE)
+    alpha_my = np.ones((nx, ny), dtype=common.DTYPE)
+
+    ramp = (np.arange(w, dtype=common.DTYPE) + 1) / w
+    alpha_x[:w, :] = ramp[:, None]
+    alpha_x[-w:, :] = ramp[::-1, None]
+    alpha_mx[:w, :] = ramp[:, None]
+    alpha_mx[-w:, :] = ramp[::-1, None]
+    alpha_y[:, :w] = ramp[None, :]
+    alpha_y[:, -w:] = ramp[None, ::-1]
+    alpha_my[:, :w] = ramp[None, :]
+    alpha_my[:, -w:] = ramp[None, ::-1]
+
+    bex = _decay_factor(sigmas[0], alpha_x, k, decay)
+    bey = _decay_factor(sigmas[1], alpha_y, k, decay)
+    bhx = _decay_factor(sigmas[2], alpha_mx, k, decay)
+    bhy = _decay_factor(sigmas[3], alpha_my, k, decay)
+
+    aex = np.subtract(bex, 1)
+    aex *= 1 / dx
+    aey = np.subtract(bey, 1)
+    aey *= 1 / dy
+    ahx = np.subtract(bhx, 1)
+    ahx *= 1 / dx
+    ahy = np.subtract(bhy, 1)
+    ahy *= 1 / dy
+
+    return CpmlAuxConstants(aex, aey, ahx, ahy, bex, bey, bhx, bhy)
+
+
+@njit(parallel=True, fastmath=True, cache=True, boundscheck=False)
+def _cpml_step(ex, ey, hz, pex, pey, phx, phy, cex, cey, chx, chy, px, py, pm, aex, aey, ahx, ahy, bex, bey, bhx, bhy,
+               sx, sy, sval):
+    """
+    Advances the fields and the auxiliary fields of the CPML by one time step in place.
+    The update is fused into two sweeps over the rows: the first one updates phy, phx and hz of every cell, the
+    second one pey, pex, ex and ey, each auxiliary value being used right after it was computed.
+    Two sweeps are needed because ex and ey depend on the new hz of the neighbouring cells.
+    :param sx: int
+    :param sy: int
+    :param sval: float
+    """
+    nx, ny = hz.shape
+
+    for i in prange(nx):
+        for j in range(ny):
+            dex = ex[i, j + 1] - ex[i, j]
+            dey = ey[i + 1, j] - ey[i, j]
+            phy[i, j] = bhy[i, j] * phy[i, j] + ahy[i, j] * dex
+            phx[i, j] = bhx[i, j] * phx[i, j] + ahx[i, j] * dey
+            hz[i, j] += -chy[i, j] * dey + chx[i, j] * dex + pm[i, j] * (phy[i, j] - phx[i, j])
+    hz[sx, sy] = sval
+
+    for i in prange(nx):
+        for j in range(ny - 1):
+            dhz = hz[i, j + 1] - hz[i, j]
+            pey[i, j] = bey[i, j] * pey[i, j] + aey[i, j] * dhz
+            ex[i, j + 1] += cex[i, j] * dhz + px[i, j] * pey[i, j]
+        if i > 0:
+            for j in range(ny):
+                dhz = hz[i, j] - hz[i - 1, j]
+                pex[i - 1, j] = bex[i - 1, j] * pex[i - 1, j] + aex[i - 1, j] * dhz
+                ey[i, j] -= cey[i - 1, j] * dhz + py[i - 1, j] * pex[i - 1, j]
+
+
+@njit(fastmath=True, cache=True, boundscheck=False)
+def _cpml_wavefront(ex, ey, hz, pex, pey, phx, phy, cex, cey, chx, chy, px, py, pm, aex, aey, ahx, ahy,
+                    bex, bey, bhx, bhy, history, record, probes, probe_x, probe_y, t0, steps, sx, sy, source_vals):
+    """
+    Advances the fields by "steps" time steps starting at time step "t0" in a single sweep over the rows, so that
+    every row is reused for all of these time steps while it is still in the cache.
+    The time steps are skewed by one row each: at position p of the sweep, row p - s is advanced to time step
+    t0 + s, first the H sweep and then the E sweep of "_cpml_step". This is the earliest position at which the
+    neighbouring rows hold the values of the previous time step, and the latest one before they are overwritten.
+    If "record" is set, the values of "hz" are written to "history[t0:t0 + steps]" row by row, and those at the probe
+    points to "probes[:, t0:t0 + steps]" as their rows are completed.
+    :param history: np.ndarray of size [nt, nx, ny]
+    :param record: bool
+    :param probes: np.ndarray of size [n, nt]
+    :param probe_x: np.ndarray of size n
+    :param probe_y: np.ndarray of size n
+    :param t0: int
+    :param steps: int
+    :param sx: int
+    :param sy: int
+    :param source_vals: np.ndarray of size nt
+    """
+    nx, ny = hz.shape
 
-    alpha_x = np.ones((nx-1, ny))
-    alpha_y = np.ones((nx, ny-1))
-    alpha_mx = np.ones((nx, ny))
-    alpha_my = np.ones((nx, ny))
+    for p in range(nx + steps - 1):
+        for s in range(max(0, p - nx + 1), min(steps, p + 1)):
+            i = p - s
+            for j in range(ny):
+                dex = ex[i, j + 1] - ex[i, j]
+                dey = ey[i + 1, j] - ey[i, j]
+                phy[i, j] = bhy[i, j] * phy[i, j] + ahy[i, j] * dex
+                phx[i, j] = bhx[i, j] * phx[i, j] + ahx[i, j] * dey
+                hz[i, j] += -chy[i, j] * dey + chx[i, j] * dex + pm[i, j] * (phy[i, j] - phx[i, j])
+            if i == sx:
+                hz[sx, sy] = source_vals[t0 + s]
+            if record:
+                history[t0 + s, i] = hz[i]
+            for k in range(probes.shape[0]):
+                if probe_x[k] == i:
+                    probes[k, t0 + s] = hz[i, probe_y[k]]
 
-    for i in range(10):
-        alpha_x[i, :] = (i + 1) / 10
-        alpha_x[-i - 1, :] = (i + 1) / 10
-        alpha_mx[i, :] = (i + 1) / 10
-        alpha_mx[-i - 1, :] = (i + 1) / 10
-        alpha_y[:, i] = (i + 1) / 10
-        alpha_y[:, -i - 1] = (i + 1) / 10
-        alpha_my[:, i] = (i + 1) / 10
-        alpha_my[:, -i - 1] = (i + 1) / 10
+            for j in range(ny - 1):
+                dhz = hz[i, j + 1] - hz[i, j]
+                pey[i, j] = bey[i, j] * pey[i, j] + aey[i, j] * dhz
+                ex[i, j + 1] += cex[i, j] * dhz + px[i, j] * pey[i, j]
+            if i > 0:
+                for j in range(ny):
+                    dhz = hz[i, j] - hz[i - 1, j]
+                    pex[i - 1, j] = bex[i - 1, j] * pex[i - 1, j] + aex[i - 1, j] * dhz
+                    ey[i, j] -= cey[i - 1, j] * dhz + py[i - 1, j] * pex[i - 1, j]
 
-    bex = np.exp(-(sigmas[0]/(k + alpha_x)) * (dt / const.epsilon_0))
-    bey = np.exp(-(sigmas[1]/(k + alpha_y)) * (dt / const.epsilon_0))
-    bhx = np.exp(-(sigmas[2]/(k + alpha_mx)) * (dt / const.epsilon_0))
-    bhy = np.exp(-(sigmas[3]/(k + alpha_my)) * (dt / const.epsilon_0))
 
-    aex = (bex - 1) / dx
-    aey = (bey - 1) / dy
-    ahx = (bhx - 1) / dx
-    ahy = (bhy - 1) / dy
+def make_scratch(hz, xp=np):
+    """
+    Creates the buffers of "common.make_scratch" and one more for the products of the CPML coefficients and the
+    auxiliary fields.
+    :param hz: np.ndarray of size (nx, ny)
+    :param xp: module, numpy or cupy
+    :return: List[5 np.ndarrays]
+    """
+    diff_x, diff_y, diff_hx, diff_hy = common.make_scratch(hz, xp)
+    product = xp.empty(hz.shape, dtype=hz.dtype)
+    return [diff_x, diff_y, product, diff_hx, diff_hy]
+
+
+def _numpy_step(fields, aux_fields, constants, aux_constants, scratch, sourcepoint, sval, xp=np):
+    """
+    Advances the fields and the auxiliary fields of the CPML by one time step in place using array expressions.
+    :param fields: List[3 np.ndarrays]
+    :param aux_fields: List[4 np.ndarrays]
+    :param constants: CpmlConstants
+    :param aux_constants: CpmlAuxConstants
+    :param scratch: List[5 np.ndarrays]
+    :param sourcepoint: Tuple(int, int)
+    :param sval: float
+    :param xp: module, numpy or cupy
+    """
+    ex, ey, hz = fields
+    pex, pey, phx, phy = aux_fields
+    cex, cey, chx, chy, px, py, pm = constants
+    aex, aey, ahx, ahy, bex, bey, bhx, bhy = aux_constants
+    diff_x, diff_y, product, diff_hx, diff_hy = scratch
+    product_hx = product[:-1, :]
+    product_hy = product[:, :-1]
+
+    xp.subtract(ex[:, 1:], ex[:, :-1], out=diff_y)
+    phy *= bhy
+    xp.multiply(ahy, diff_y, out=product)
+    phy += product
+    xp.subtract(ey[1:, :], ey[:-1, :], out=diff_x)
+    phx *= bhx
+    xp.multiply(ahx, diff_x, out=product)
+    phx += product
 
-    return [aex, aey, ahx, ahy, bex, bey, bhx, bhy]
+    diff_x *= chy
+    hz -= diff_x
+    diff_y *= chx
+    hz += diff_y
+    xp.subtract(phy, phx, out=product)
+    product *= pm
+    hz += product
+    hz[sourcepoint] = sval
 
+    xp.subtract(hz[:, 1:], hz[:, :-1], out=diff_hy)
+    pey *= bey
+    xp.multiply(aey, diff_hy, out=product_hy)
+    pey += product_hy
+    xp.subtract(hz[1:, :], hz[:-1, :], out=diff_hx)
+    pex *= bex
+    xp.multiply(aex, diff_hx, out=product_hx)
+    pex += product_hx
 
-def evolution(nt, fields, aux_fields, constants, aux_constants, history, sourcepoint, source):
+    diff_hy *= cex
+    ex[:, 1:-1] += diff_hy
+    xp.multiply(px, pey, out=product_hy)
+    ex[:, 1:-1] += product_hy
+    diff_hx *= cey
+    ey[1:-1, :] -= diff_hx
+    xp.multiply(py, pex, out=product_hx)
+    ey[1:-1, :] -= product_hx
+
+
+def evolution(nt, fields, aux_fields, constants, aux_constants, history, sourcepoint, source_vals, probe_points=None):
     """
     Calculate the behavior of the situation determined by the "constants" and "aux_constants".
-    A source determined by the function "source" excites the field at point "sourcepoint".
+    The source excites the field at point "sourcepoint" with the value "source_vals[t]" at time step t.
     The value of "hz" at each timestep is stored in "history" which is then returned.
+    If "probe_points" are given, only the values of "hz" at these points are stored and returned instead.
     :param nt: int
     :param fields: List[3 np.ndarrays]
     :param aux_fields: List[4 np.ndarrays]
-    :param constants: List[7 np.ndarrays]
-    :param aux_constants: List[8 np.ndarrays]
-    :param history: np.ndarray of size [nx, ny, nt]
-    :param sourcepoint: Tuple(float, float)
-    :param source: function
-    :return: np.ndarray of size [nx, ny, nt]
+    :param constants: CpmlConstants
+    :param aux_constants: CpmlAuxConstants
+    :param history: np.ndarray of size [nt, nx, ny], or None to only keep the final hz
+    :param sourcepoint: Tuple(int, int), negative indices count from the end
+    :param source_vals: np.ndarray of size nt
+    :param probe_points: List[Tuple(int, int)], negative indices count from the end
+    :return: np.ndarray of size [nt, nx, ny], or hz of size [nx, ny] if "history" is None,
+             or np.ndarray of size [len(probe_points), nt] if "probe_points" are given
     """
     ex, ey, hz = fields
+    sourcepoint = common.grid_index(sourcepoint, hz.shape)
     pex, pey, phx, phy = aux_fields
-    cex, cey, chy, chx, px, py, pm = constants
+    cex, cey, chx, chy, px, py, pm = constants
     aex, aey, ahx, ahy, bex, bey, bhx, bhy = aux_constants
+    record = history is not None
+    probing = probe_points is not None
+    probes, probe_x, probe_y = common.make_probes(probe_points, nt, hz.shape)
+
+    if NUMBA and get_num_threads() == 1:
+        # the wavefront is sequential, with more threads the parallel time step is preferred
+        # without a history, hz stands in for it so the kernel keeps its argument types; it is never written
+        sx, sy = sourcepoint
+        target = history if record else hz[np.newaxis]
+        for t in range(0, nt, TIME_BLOCK):
+            _cpml_wavefront(ex, ey, hz, pex, pey, phx, phy, cex, cey, chx, chy, px, py, pm,
+                            aex, aey, ahx, ahy, bex, bey, bhx, bhy, target, record, probes, probe_x, probe_y,
+                            t, min(TIME_BLOCK, nt - t), sx, sy, source_vals)
+    else:
+        if NUMBA:
+            sx, sy = sourcepoint
+
+            def step(t):
+                _cpml_step(ex, ey, hz, pex, pey, phx, phy, cex, cey, chx, chy, px, py, pm,
+                           aex, aey, ahx, ahy, bex, bey, bhx, bhy, sx, sy, source_vals[t])
+        elif _c_step is not None:
+            nx, ny = hz.shape
+            sx, sy = sourcepoint
+
+            def step(t):
+                _c_step(nx, ny, ex, ey, hz, pex, pey, phx, phy, cex, cey, chx, chy, px, py, pm,
+                        aex, aey, ahx, ahy, bex, bey, bhx, bhy, sx, sy, source_vals[t])
+        else:
+            scratch = make_scratch(hz)
+
+            def step(t):
+                _numpy_step(fields, aux_fields, constants, aux_constants, scratch, sourcepoint, source_vals[t])
 
-    for t in range(nt):
-        phy = bhy * phy + ahy * (ex[:, 1:] - ex[:, :-1])
-        phx = bhx * phx + ahx * (ey[1:, :] - ey[:-1, :])
+        for t in range(nt):
+            step(t)
+            if record:
+                np.copyto(history[t], hz)
+            if probing:
+                probes[:, t] = hz[probe_x, probe_y]
 
-        hz = hz - chy * (ey[1:, :] - ey[:-1, :]) + chx * (ex[:, 1:] - ex[:, :-1]) + pm * (phy - phx)
-        hz[sourcepoint] = source(t)
+    if probing:
+        return probes
+    return history if record else hz
 
-        pey = bey * pey + aey * (hz[:, 1:] - hz[:, :-1])
-        pex = bex * pex + aex * (hz[1:, :] - hz[:-1, :])
 
-        ex[:, 1:-1] = ex[:, 1:-1] + cex * (hz[:, 1:] - hz[:, :-1]) + px * pey
-        ey[1:-1, :] = ey[1:-1, :] - cey * (hz[1:, :] - hz[:-1, :]) - py * pex
+def gpu_evolution(nt, fields, aux_fields, constants, aux_constants, history, sourcepoint, source_vals, chunk=32,
+                  probe_points=None):
+    """
+    Same as "evolution", but runs the array implementation of the time step on the GPU using CuPy.
+    Fields and constants are copied to the device once; "gpu.run" streams the values of "hz" back into "history".
+    The values at the probe points are collected on the device and copied back once at the end.
+    :param nt: int
+    :param fields: List[3 np.ndarrays]
+    :param aux_fields: List[4 np.ndarrays]
+    :param constants: CpmlConstants
+    :param aux_constants: CpmlAuxConstants
+    :param history: np.ndarray of size [nt, nx, ny], or None to only keep the final hz
+    :param sourcepoint: Tuple(int, int), negative indices count from the end
+    :param source_vals: np.ndarray of size nt
+    :param chunk: int
+    :param probe_points: List[Tuple(int, int)], negative indices count from the end
+    :return: np.ndarray of size [nt, nx, ny], or hz of size [nx, ny] if "history" is None,
+             or np.ndarray of size [len(probe_points), nt] if "probe_points" are given
+    """
+    import cupy as cp
+
+    sourcepoint = common.grid_index(sourcepoint, fields[2].shape)
+    fields = [cp.asarray(field) for field in fields]
+    aux_fields = [cp.asarray(field) for field in aux_fields]
+    constants = CpmlConstants(*(cp.asarray(constant) for constant in constants))
+    aux_constants = CpmlAuxConstants(*(cp.asarray(constant) for constant in aux_constants))
+    scratch = make_scratch(fields[2], cp)
+    probes, probe_x, probe_y = (cp.asarray(a) for a in common.make_probes(probe_points, nt, fields[2].shape))
 
-        history[:, :, t] = hz
+    def step(t):
+        _numpy_step(fields, aux_fields, constants, aux_constants, scratch, sourcepoint, source_vals[t], cp)
+        if probe_points is not None:
+            probes[:, t] = fields[2][probe_x, probe_y]
 
-    return history
+    result = gpu.run(nt, step, fields[2], history, chunk)
+    return cp.asnumpy(probes) if probe_points is not None else result
@@ -0,0 +1,55 @@
+/*
+ * Time step of the CPML simulation in C, the same two sweeps as "_cpml_step" in cpml.py.
+ * All arrays are C-contiguous float32 arrays with the shapes given in cpml.py; nx and ny are the shape of hz.
+ * Without numba, cpml.py uses it instead of the NumPy implementation if the library has been built with
+ *
+ *     gcc -O3 -march=native -ffast-math -fopenmp -shared -fPIC -o src/libcpml_step.so src/cpml_step.c
+ */
+
+void cpml_step(int nx, int ny,
+               float *restrict ex, float *restrict ey, float *restrict hz,
+               float *restrict pex, float *restrict pey, float *restrict phx, float *restrict phy,
+               const float *restrict cex, const float *restrict cey, const float *restrict chx,
+               const float *restrict chy, const float *restrict px, const float *restrict py,
+               const float *restrict pm,
+               const float *restrict aex, const float *restrict aey, const float *restrict ahx,
+               const float *restrict ahy,
+               const float *restrict bex, const float *restrict bey, const float *restrict bhx,
+               const float *restrict bhy,
+               int sx, int sy, float sval)
+{
+    /* rows of ex have ny + 1 entries, rows of pey, cex and px ny - 1, all other rows ny */
+    #pragma omp parallel for
+    for (int i = 0; i < nx; i++) {
+        #pragma omp simd
+        for (int j = 0; j < ny; j++) {
+            int c = i * ny + j;
+            float dex = ex[i * (ny + 1) + j + 1] - ex[i * (ny + 1) + j];
+            float dey = ey[c + ny] - ey[c];
+            phy[c] = bhy[c] * phy[c] + ahy[c] * dex;
+            phx[c] = bhx[c] * phx[c] + ahx[c] * dey;
+            hz[c] += -chy[c] * dey + chx[c] * dex + pm[c] * (phy[c] - phx[c]);
+        }
+    }
+    hz[sx * ny + sy] = sval;
+
+    #pragma omp parallel for
+    for (int i = 0; i < nx; i++) {
+        #pragma omp simd
+        for (int j = 0; j < ny - 1; j++) {
+            int c = i * (ny - 1) + j;
+            float dhz = hz[i * ny + j + 1] - hz[i * ny + j];
+            pey[c] = bey[c] * pey[c] + aey[c] * dhz;
+            ex[i * (ny + 1) + j + 1] += cex[c] * dhz + px[c] * pey[c];
+        }
+        if (i > 0) {
+            #pragma omp simd
+            for (int j = 0; j < ny; j++) {
+                int c = (i - 1) * ny + j;
+                float dhz = hz[c + ny] - hz[c];
+                pex[c] = bex[c] * pex[c] + aex[c] * dhz;
+                ey[c + ny] -= cey[c] * dhz + py[c] * pex[c];
+            }
+        }
+    }
+}
@@ -0,0 +1,57 @@
+"""
+Time loop shared by the CuPy GPU backends of all three simulations.
+CuPy is only imported when a GPU simulation is actually run.
+"""
+
+
+def run(nt, step, hz, history, chunk=32):
+    """
+    Calls "step(t)" for every time step t, which advances the fields residing on the GPU by one time step.
+    The values of the device array "hz" are collected on the device in blocks of "chunk" time steps; each full block
+    is copied to pinned host memory on a separate stream while the following block is computed, and only then written
+    into "history". Without a history, only the final hz is copied back.
+    :param nt: int
+    :param step: function
+    :param hz: cupy.ndarray of size [nx, ny]
+    :param history: np.ndarray of size [nt, nx, ny], or None to only keep the final hz
+    :param chunk: int
+    :return: np.ndarray of size [nt, nx, ny], or hz of size [nx, ny] if "history" is None
+    """
+    import cupy as cp
+    import cupyx
+
+    if history is None:
+        for t in range(nt):
+            step(t)
+        return cp.asnumpy(hz)
+
+    # two device blocks and two pinned host blocks, so one can be copied while the other is filled
+    blocks = [cp.empty((chunk,) + hz.shape, dtype=hz.dtype) for _ in range(2)]
+    pinned = [cupyx.empty_pinned((chunk,) + hz.shape, dtype=hz.dtype) for _ in range(2)]
+    copy_stream = cp.cuda.Stream(non_blocking=True)
+    pending = None  # (first time step, number of time steps, block index) of the copy in flight
+
+    def drain():
+        copy_stream.synchronize()
+        start, count, b = pending
+        history[start:start + count] = pinned[b][:count]
+
+    for t in range(nt):
+        step(t)
+        b, k = (t // chunk) % 2, t % chunk
+        blocks[b][k] = hz
+        if k == chunk - 1 or t == nt - 1:
+            if pending is not None:
+                drain()
+            copy_stream.wait_event(cp.cuda.get_current_stream().record())
+            # without blocking=False the host waits for the copy here, and it would not overlap the next block
+            try:
+                blocks[b][:k + 1].get(stream=copy_stream, out=pinned[b][:k + 1], blocking=False)
+            except TypeError:
+                # CuPy before version 11 has no "blocking" argument and always waits
+                blocks[b][:k + 1].get(stream=copy_stream, out=pinned[b][:k + 1])
+            pending = (t - k, k + 1, b)
+
+    if pending is not None:
+        drain()
+    return history
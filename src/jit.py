@@ -0,0 +1,65 @@
+"""
+Optional Numba support for the time-stepping kernels.
+If numba is installed, "njit", "prange" and "get_num_threads" are the real thing and NUMBA is True.
+Otherwise "njit" leaves the decorated function untouched, "prange" is plain range, "get_num_threads"
+returns 1 and the implementations fall back to their NumPy update equations, or to the compiled C libraries
+loaded with "load_c_function" if these have been built.
+"""
+import ctypes
+import os
+
+import numpy as np
+
+# argument type of the float32 arrays passed to the C libraries
+C_ARRAY = np.ctypeslib.ndpointer(dtype=np.float32, flags="C_CONTIGUOUS")
+
+try:
+    from numba import get_num_threads, njit, prange
+
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """
+        Stand-in for numba.njit that returns the decorated function unchanged.
+        Supports both the bare "@njit" and the "@njit(...)" form.
+        """
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+
+        def decorator(function):
+            return function
+
+        return decorator
+
+    def get_num_threads():
+        """
+        Stand-in for numba.get_num_threads; without numba everything runs on one thread.
+        """
+        return 1
+
+
+def load_c_function(library, name, argtypes, dtype):
+    """
+    Loads the function "name" from the shared library "library", if it has been built next to this file.
+    The C implementations work on float32 arrays only, so nothing is loaded for any other "dtype". A library that
+    cannot be loaded, e.g. one built for another architecture, is skipped as if it were missing, so the callers
+    fall back to NumPy.
+    :param library: string, file name of the library
+    :param name: string
+    :param argtypes: List[ctypes types]
+    :param dtype: np.dtype of the fields
+    :return: function or None
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), library)
+    if dtype != np.float32 or not os.path.exists(path):
+        return None
+    try:
+        function = getattr(ctypes.CDLL(path), name)
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = argtypes
+    function.restype = None
+    return function
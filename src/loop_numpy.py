@@ -1,9 +1,9 @@
 import numpy as np
-import timeit
 import common
 import scipy.constants as const
 import math
 import source as src
+from jit import njit
 
 timesteps = 200
 dx = 0.05
@@ -15,72 +15,51 @@ def prelim():
     mu = const.mu_0
     N = 100
     fields = common.make_fields(N, N)
-    history = np.zeros((N, N, timesteps))
+    history = np.zeros((timesteps, N, N))
 
-    q = int(N/2)
+    q = N // 2
 
     num = 1
     rep = 100
+    loop_rep = 3  # the interpreted loops take seconds per run
     constants = other_constants(eps, mu, dx, dy, dt)
 
+    source_values = src.simple_sin_source_array(timesteps)
+
     def loopycaller():
         loopy(fields, constants, history, N, q)
 
+    def jitloopycaller():
+        jit_loopy(*fields, *constants, N, q, source_values)
+
     def numpylycaller():
-        #constants = other_constants(eps, mu, dx, dy, dt)
-        numpyly(fields, constants, history, N, q)
-
-    def numpylosscaller():
-        #constants = loss_constants(eps, mu, 0, 0, dx, dy, dt)
-        numpyly_loss(fields, constants, history, N, q)
-
-    loopytime = timeit.repeat(loopycaller, number = num, repeat = rep)
-    numpylytime = timeit.repeat(numpylycaller, number = num, repeat = rep)
-    #numpylosstime = timeit.timeit(numpylycaller, number = num) / num
-    print(loopytime)
-    print(numpylytime)
-
-    loopytime = np.min(loopytime)
-    numpylytime = np.min(numpylytime)
-    loopytime = loopytime/numpylytime
-
-    loopy_mean = np.mean(loopytime)
-    numpyly_mean = np.mean(numpylytime)
-    loopy_mean = loopy_mean/numpylytime
-    numpyly_mean = numpyly_mean/numpylytime
-    print("loopytime mean:", loopy_mean)
-    print("numpytime mean:", numpyly_mean)
-
-    loopy_std = np.std(loopytime)
-    numpyly_std = np.std(numpylytime)
-    loopy_std = loopy_std/numpylytime
-    numpyly_std = numpyly_std/numpylytime
-    print("loopytime std:", loopy_std)
-    print("numpytime std:", numpyly_std)
-
-    numpylytime = 1
-    print("loopytime min:", loopytime)
-    print("numpytime min:", numpylytime)
-    # history = numpyly(fields, constants, history, N, q)
-    history = loopy(fields, constants, history, N, q)
-    common.plot2d(history, timesteps)
-
-    return [loopytime, numpylytime]
-    #return [numpylytime, numpylosstime]
+        numpyly(fields, constants, N, q, source_values)
+
+    # common.bench makes one untimed call first, so the JIT compilation is not included
+    numpylytime = common.bench(numpylycaller, rep, num)
+    loopytime = common.bench(loopycaller, loop_rep, num)
+    jitloopytime = common.bench(jitloopycaller, rep, num)
+
+    # minimum, mean and standard deviation as multiples of the minimum time of the NumPy version
+    names = ["numpyly", "loopy", "jit_loopy"]
+    results = common.compare([numpylytime, loopytime, jitloopytime])
+    for i in range(len(names)):
+        print(names[i], ": ", results[i])
+    return results
 
 def other_constants(eps, mu, dx, dy, dt):
     cex = dt / (dy*eps)
     cey = dt / (dx*eps)
     chx = dt / (dy*mu)
     chy = dt / (dx*mu)
-    return [cex, cey, chx, chy]
+    return cex, cey, chx, chy
 
 def loss_constants(eps, mu, sigma, sigmam, dx, dy, dt):
     cex1 = (2 * eps - sigma * dt) / (2 * eps + sigma * dt)
     cex2 = ((2 * dt) / (2 * eps + sigma * dt)) / dy
     chz1 = (2 * mu - sigmam * dt) / (2 * mu + sigmam * dt)
     chz2 = ((2 * dt) / (2 * mu + sigmam * dt)) / dx
-    return [cex1, cex2, chz1, chz2]
+    return cex1, cex2, chz1, chz2
 
 def loopy(fields, constants, history, N, q):
     ex, ey, hz = fields
@@ -101,6 +80,36 @@ def loopy(fields, constants, history, N, q):
 #                history[i,j,t] = hz[i,j]
 #    return history
 
+def numpyly(fields, constants, N, q, source_values):
+    """
+    The updates of "loopy" as array expressions, one per field and time step.
+    """
+    ex, ey, hz = fields
+    cex, cey, chx, chy = constants
+    for t in range(timesteps):
+        ex[:, 1:N - 1] += cex * (hz[:, 1:N - 1] - hz[:, :N - 2])
+        ey[1:N - 1, :] -= cey * (hz[1:N - 1, :] - hz[:N - 2, :])
+        hz += chy * (ex[:, 1:] - ex[:, :-1]) - chx * (ey[1:, :] - ey[:-1, :])
+        hz[q, q] = source_values[t]
+
+@njit(cache=True, fastmath=True)
+def jit_loopy(ex, ey, hz, cex, cey, chx, chy, N, q, source_values):
+    """
+    The loops of "loopy" compiled with Numba. The source is passed as precomputed "source_values"
+    since the compiled function cannot call back into Python.
+    """
+    for t in range(timesteps):
+        for i in range(N):
+            for j in range(1, N - 1):
+                ex[i, j] = ex[i, j] + cex * (hz[i, j] - hz[i, j - 1])
+        for i in range(1, N - 1):
+            for j in range(N):
+                ey[i, j] = ey[i, j] - cey * (hz[i, j] - hz[i - 1, j])
+        for i in range(N):
+            for j in range(N):
+                hz[i, j] = hz[i, j] + chy * (ex[i, j + 1] - ex[i, j]) - chx * (ey[i + 1, j] - ey[i, j])
+        hz[q, q] = source_values[t]
+
 prelim()
 
 
@@ -26,7 +26,7 @@ def __init__():
     dt = (const.c * math.sqrt((dx ** -2) + (dy ** -2))) ** -1  #
     nt = 200  # number of time steps for which the computation is run
     pmlc = (10, 1e-6, 3)  # (thickness of the PML in cells, desired reflection factor R0, grading parameter)
-    p = (int(nx / 2), int(ny / 2))  # point where the source term is added
+    p = (nx // 2, ny // 2)  # point where the source term is added
     source = src.simple_sin_source
 
     params = [nx, ny, lx, ly, dx, dy, dt, nt, p, pmlc, source]  # package the parameters in a list
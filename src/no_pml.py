@@ -1,5 +1,24 @@
+import ctypes
+
+import numpy as np
 import scipy.constants as const
 
+import common
+import gpu
+from jit import C_ARRAY, NUMBA, get_num_threads, load_c_function, njit, prange
+
+# number of time steps advanced per sweep of "_evolve_wavefront"
+TIME_BLOCK = 8
+# the wavefront only pays off once the fields no longer fit in the cache; smaller grids use "_evolve_kernel"
+WAVEFRONT_CELLS = 2500 * 2500
+
+# time loop compiled from "no_pml_evolve.c", used instead of the NumPy implementation when numba is not installed
+_c_evolve = load_c_function("libno_pml_evolve.so", "evolve",
+                            [ctypes.c_int] * 3 + [C_ARRAY] * 3 + [ctypes.c_float] * 4 + [C_ARRAY, ctypes.c_int]
+                            + [ctypes.c_int] * 2
+                            + [np.ctypeslib.ndpointer(dtype=np.float64, flags="C_CONTIGUOUS"), ctypes.c_int],
+                            common.DTYPE)
+
 
 def calculate_constants(dx, dy, dt):
     """
@@ -7,7 +26,7 @@ def calculate_constants(dx, dy, dt):
     :param dx: float
     :param dy: float
     :param dt: float
-    :return: List[4 floats]
+    :return: Tuple[4 floats] of type common.DTYPE
     """
     eps = const.epsilon_0
     mu = const.mu_0
@@ -17,62 +36,205 @@ def calculate_constants(dx, dy, dt):
     chzx = dt / (mu * dx)
     chzy = dt / (mu * dy)
 
-    return [cex, cey, chzx, chzy]
+    return common.DTYPE(cex), common.DTYPE(cey), common.DTYPE(chzx), common.DTYPE(chzy)
 
 
-def evolution(nt, fields, constants, history, sourcepoint, source):
+@njit(parallel=True, fastmath=True, cache=True, boundscheck=False)
+def _evolve_kernel(nt, ex, ey, hz, cex, cey, chzx, chzy, history, record, probes, probe_x, probe_y, sx, sy,
+                   source_vals):
     """
-    Calculate the behavior of the situation determined by the "constants" with a matrix implementation without a pml.
-    A source determined by the function "source" excites the field at point "sourcepoint".
-    The value of "hz" at each timestep is stored in "history" which is then returned.
+    The time loop of "evolution" compiled with numba. Every time step makes two passes over the grid, one updating
+    hz and one updating ex and ey of each row, without any temporary arrays.
+    Both passes are split over the rows with prange; the second one only starts once hz is complete.
+    If "record" is set, hz is copied to "history[t]" row by row during the second pass.
+    The values of hz at the points ("probe_x[k]", "probe_y[k]") are stored in "probes[k, t]".
     :param nt: int
+    :param history: np.ndarray of size (nt, nx, ny)
+    :param record: bool
+    :param probes: np.ndarray of size (n, nt)
+    :param probe_x: np.ndarray of size n
+    :param probe_y: np.ndarray of size n
+    :param sx: int
+    :param sy: int
+    :param source_vals: np.ndarray of size nt, or None for no source
+    """
+    nx, ny = hz.shape
+    for t in range(nt):
+        for i in prange(nx):
+            for j in range(ny):
+                hz[i, j] += -chzx * (ey[i + 1, j] - ey[i, j]) + chzy * (ex[i, j + 1] - ex[i, j])
+        if source_vals is not None:
+            hz[sx, sy] = source_vals[t]
+        for k in range(probes.shape[0]):
+            probes[k, t] = hz[probe_x[k], probe_y[k]]
+
+        for i in prange(nx):
+            for j in range(1, ny):
+                ex[i, j] += cex * (hz[i, j] - hz[i, j - 1])
+            if i > 0:
+                for j in range(ny):
+                    ey[i, j] -= cey * (hz[i, j] - hz[i - 1, j])
+            if record:
+                history[t, i] = hz[i]
+
+
+@njit(fastmath=True, cache=True, boundscheck=False)
+def _evolve_wavefront(ex, ey, hz, cex, cey, chzx, chzy, history, record, probes, probe_x, probe_y, t0, steps, sx, sy,
+                      source_vals):
+    """
+    Advances the fields by "steps" time steps starting at time step "t0" in a single sweep over the rows, in the same
+    way as "cpml._cpml_wavefront": at position p of the sweep, row p - s is advanced to time step t0 + s, so every
+    row is reused for all of these time steps while it is still in the cache.
+    If "record" is set, the values of "hz" are written to "history[t0:t0 + steps]" row by row, and those at the probe
+    points to "probes[:, t0:t0 + steps]" as their rows are completed.
+    :param history: np.ndarray of size (nt, nx, ny)
+    :param record: bool
+    :param probes: np.ndarray of size (n, nt)
+    :param probe_x: np.ndarray of size n
+    :param probe_y: np.ndarray of size n
+    :param t0: int
+    :param steps: int
+    :param sx: int
+    :param sy: int
+    :param source_vals: np.ndarray of size nt, or None for no source
+    """
+    nx, ny = hz.shape
+    for p in range(nx + steps - 1):
+        for s in range(max(0, p - nx + 1), min(steps, p + 1)):
+            i = p - s
+            for j in range(ny):
+                hz[i, j] += -chzx * (ey[i + 1, j] - ey[i, j]) + chzy * (ex[i, j + 1] - ex[i, j])
+            if source_vals is not None:
+                if i == sx:
+                    hz[sx, sy] = source_vals[t0 + s]
+            if record:
+                history[t0 + s, i] = hz[i]
+            for k in range(probes.shape[0]):
+                if probe_x[k] == i:
+                    probes[k, t0 + s] = hz[i, probe_y[k]]
+
+            for j in range(1, ny):
+                ex[i, j] += cex * (hz[i, j] - hz[i, j - 1])
+            if i > 0:
+                for j in range(ny):
+                    ey[i, j] -= cey * (hz[i, j] - hz[i - 1, j])
+
+
+def _numpy_step(fields, constants, scratch, sourcepoint, sval, xp=np):
+    """
+    Advances ex, ey and hz by one time step in place using array expressions.
     :param fields: List[3 np.ndarrays]
-    :param constants: List[4 floats]
-    :param history: np.ndarray of size (nx, ny, nt)
-    :param sourcepoint: Tuple(float, float)
-    :param source: function
-    :return:
+    :param constants: Tuple[4 floats]
+    :param scratch: List[4 np.ndarrays]
+    :param sourcepoint: Tuple(int, int)
+    :param sval: float, or None to skip the source
+    :param xp: module, numpy or cupy
     """
     ex, ey, hz = fields
     cex, cey, chzx, chzy = constants
-    for t in range(nt):
-        hz = hz - chzx * (ey[1:, :] - ey[:-1, :]) + chzy * (ex[:, 1:] - ex[:, :-1])
-        hz[sourcepoint] = source(t)
-        ex[:, 1:-1] = ex[:, 1:-1] + cex * (hz[:, 1:] - hz[:, :-1])
-        ey[1:-1, :] = ey[1:-1, :] - cey * (hz[1:, :] - hz[:-1, :])
-        history[:, :, t] = hz
-    return history
+    diff_x, diff_y, diff_hx, diff_hy = scratch
 
+    xp.subtract(ey[1:, :], ey[:-1, :], out=diff_x)
+    diff_x *= chzx
+    hz -= diff_x
+    xp.subtract(ex[:, 1:], ex[:, :-1], out=diff_y)
+    diff_y *= chzy
+    hz += diff_y
+    if sval is not None:
+        hz[sourcepoint] = sval
 
-def loop_evolution(nx, ny, nt, fields, constants, history, sourcepoint, source):
+    xp.subtract(hz[:, 1:], hz[:, :-1], out=diff_hy)
+    diff_hy *= cex
+    ex[:, 1:-1] += diff_hy
+    xp.subtract(hz[1:, :], hz[:-1, :], out=diff_hx)
+    diff_hx *= cey
+    ey[1:-1, :] -= diff_hx
+
+
+def evolution(nt, fields, constants, history, sourcepoint, source_vals, probe_points=None):
     """
-    Calculate the behavior of the situation determined by the "constants" with a loop implementation.
-    A source determined by the function "source" excites the field at point "sourcepoint".
+    Calculate the behavior of the situation determined by the "constants" with a matrix implementation without a pml.
+    The source excites the field at point "sourcepoint" with the value "source_vals[t]" at time step t; without
+    source values, no source is applied at all.
     The value of "hz" at each timestep is stored in "history" which is then returned.
-    :param nx: int
-    :param ny: int
+    If "probe_points" are given, only the values of "hz" at these points are stored and returned instead.
     :param nt: int
     :param fields: List[3 np.ndarrays]
-    :param constants: List[4 floats]
-    :param history: np.ndarray of size (nx, ny, nt)
-    :param sourcepoint: Tuple(float, float)
-    :param source: function
-    :return:
+    :param constants: Tuple[4 floats]
+    :param history: np.ndarray of size (nt, nx, ny), or None to only keep the final hz
+    :param sourcepoint: Tuple(int, int), negative indices count from the end
+    :param source_vals: np.ndarray of size nt, or None for no source
+    :param probe_points: List[Tuple(int, int)], negative indices count from the end
+    :return: np.ndarray of size (nt, nx, ny), or hz of size (nx, ny) if "history" is None,
+             or np.ndarray of size (len(probe_points), nt) if "probe_points" are given
     """
     ex, ey, hz = fields
-    cex, cey, chx, chy = constants
-    for t in range(nt):
-        for i in range(nx):
-            for j in range(1, ny - 1):
-                ex[i, j] = ex[i, j] + cex * (hz[i, j] - hz[i, j - 1])
-        for i in range(1, nx - 1):
-            for j in range(ny):
-                ey[i, j] = ey[i, j] - cey * (hz[i, j] - hz[i - 1, j])
-        for i in range(nx):
-            for j in range(ny):
-                hz[i, j] = hz[i, j] + chy * (ex[i, j + 1] - ex[i, j]) - chx * (ey[i + 1, j] - ey[i, j])
-        hz[sourcepoint] = source(t)
-        for i in range(nx):
-            for j in range(ny):
-                history[i,j,t] = hz[i,j]
-    return history
+    sourcepoint = common.grid_index(sourcepoint, hz.shape)
+    cex, cey, chzx, chzy = constants
+    record = history is not None
+    probing = probe_points is not None
+    probes, probe_x, probe_y = common.make_probes(probe_points, nt, hz.shape)
+
+    if NUMBA:
+        sx, sy = sourcepoint
+        # without a history, hz stands in for it so the kernels keep their argument types; it is never written
+        target = history if record else hz[np.newaxis]
+        if get_num_threads() == 1 and hz.size >= WAVEFRONT_CELLS:
+            # the wavefront is sequential, with more threads the parallel kernel is preferred
+            for t in range(0, nt, TIME_BLOCK):
+                _evolve_wavefront(ex, ey, hz, cex, cey, chzx, chzy, target, record, probes, probe_x, probe_y,
+                                  t, min(TIME_BLOCK, nt - t), sx, sy, source_vals)
+        else:
+            _evolve_kernel(nt, ex, ey, hz, cex, cey, chzx, chzy, target, record, probes, probe_x, probe_y,
+                           sx, sy, source_vals)
+    elif _c_evolve is not None and not probing:
+        nx, ny = hz.shape
+        sx, sy = sourcepoint
+        values = np.zeros(1) if source_vals is None else np.ascontiguousarray(source_vals, dtype=np.float64)
+        _c_evolve(nt, nx, ny, ex, ey, hz, cex, cey, chzx, chzy, history if record else hz[np.newaxis], record,
+                  sx, sy, values, source_vals is not None)
+    else:
+        scratch = common.make_scratch(hz)
+        for t in range(nt):
+            _numpy_step(fields, constants, scratch, sourcepoint, None if source_vals is None else source_vals[t])
+            if record:
+                np.copyto(history[t], hz)
+            if probing:
+                probes[:, t] = hz[probe_x, probe_y]
+
+    if probing:
+        return probes
+    return history if record else hz
+
+
+def gpu_evolution(nt, fields, constants, history, sourcepoint, source_vals, chunk=32, probe_points=None):
+    """
+    Same as "evolution", but runs the array implementation of the time step on the GPU using CuPy.
+    The fields are copied to the device once; "gpu.run" streams the values of "hz" back into "history".
+    The values at the probe points are collected on the device and copied back once at the end.
+    :param nt: int
+    :param fields: List[3 np.ndarrays]
+    :param constants: Tuple[4 floats]
+    :param history: np.ndarray of size (nt, nx, ny), or None to only keep the final hz
+    :param sourcepoint: Tuple(int, int), negative indices count from the end
+    :param source_vals: np.ndarray of size nt, or None for no source
+    :param chunk: int
+    :param probe_points: List[Tuple(int, int)], negative indices count from the end
+    :return: np.ndarray of size (nt, nx, ny), or hz of size (nx, ny) if "history" is None,
+             or np.ndarray of size (len(probe_points), nt) if "probe_points" are given
+    """
+    import cupy as cp
+
+    sourcepoint = common.grid_index(sourcepoint, fields[2].shape)
+    fields = [cp.asarray(field) for field in fields]
+    scratch = common.make_scratch(fields[2], cp)
+    probes, probe_x, probe_y = (cp.asarray(a) for a in common.make_probes(probe_points, nt, fields[2].shape))
+
+    def step(t):
+        _numpy_step(fields, constants, scratch, sourcepoint, None if source_vals is None else source_vals[t], cp)
+        if probe_points is not None:
+            probes[:, t] = fields[2][probe_x, probe_y]
+
+    result = gpu.run(nt, step, fields[2], history, chunk)
+    return cp.asnumpy(probes) if probe_points is not None else result
+
@@ -0,0 +1,47 @@
+/*
+ * Time loop of the simulation without a PML in C, the same two passes per time step as "_evolve_kernel" in no_pml.py.
+ * All arrays are C-contiguous float32 arrays with the shapes given in no_pml.py, except for the float64 source values;
+ * nx and ny are the shape of hz.
+ * Without numba, no_pml.py uses it instead of the NumPy implementation if the library has been built with
+ *
+ *     gcc -O3 -march=native -ffast-math -fopenmp -shared -fPIC -o src/libno_pml_evolve.so src/no_pml_evolve.c
+ */
+
+#include <string.h>
+
+void evolve(int nt, int nx, int ny,
+            float *restrict ex, float *restrict ey, float *restrict hz,
+            float cex, float cey, float chzx, float chzy,
+            float *restrict history, int record,
+            int sx, int sy, const double *restrict source_vals, int source)
+{
+    /* rows of ex have ny + 1 entries, all other rows ny */
+    for (int t = 0; t < nt; t++) {
+        #pragma omp parallel for
+        for (int i = 0; i < nx; i++) {
+            #pragma omp simd
+            for (int j = 0; j < ny; j++) {
+                int c = i * ny + j;
+                hz[c] += -chzx * (ey[c + ny] - ey[c]) + chzy * (ex[i * (ny + 1) + j + 1] - ex[i * (ny + 1) + j]);
+            }
+        }
+        if (source)
+            hz[sx * ny + sy] = (float) source_vals[t];
+
+        #pragma omp parallel for
+        for (int i = 0; i < nx; i++) {
+            #pragma omp simd
+            for (int j = 1; j < ny; j++)
+                ex[i * (ny + 1) + j] += cex * (hz[i * ny + j] - hz[i * ny + j - 1]);
+            if (i > 0) {
+                #pragma omp simd
+                for (int j = 0; j < ny; j++) {
+                    int c = i * ny + j;
+                    ey[c] -= cey * (hz[c] - hz[c - ny]);
+                }
+            }
+            if (record)
+                memcpy(history + ((long) t * nx + i) * ny, hz + i * ny, ny * sizeof(float));
+        }
+    }
+}
@@ -9,11 +9,41 @@ def simple_sin_source(n):
     return np.sin(n / 5)
 
 
+def simple_sin_source_array(nt):
+    """
+    The values of "simple_sin_source" for all "nt" time steps, computed with a single call to np.sin.
+    :param nt: int
+    :return: np.ndarray of size nt
+    """
+    return simple_sin_source(np.arange(nt, dtype=float))
+
+
 def null_source(n):
     """
-    Returns 0. Designed to mimic a real source as closely as possible - thus the unnecessary argument
-    and equally unnecessary multiplication operation
+    Returns 0.0 for every time step, so it has the signature of a real source.
+    "callers.call_npml" does not evaluate it: given this function, it skips the source injection entirely, which
+    leaves the field at the sourcepoint free instead of holding it at 0.
     :param n: int
     :return: float
     """
-    return n * 0
+    return 0.0
+
+
+def source_values(source, nt):
+    """
+    Evaluates the function "source" for all time steps at once, so the time loops only have to index an array
+    instead of calling back into Python every time step. If "source" already is an array of values, it is returned
+    as is after checking that it holds one value per time step, as the compiled kernels do not check their indices;
+    the values of "simple_sin_source" are computed with a single vectorized call.
+    :param source: function or np.ndarray of size nt
+    :param nt: int
+    :return: np.ndarray of size nt
+    """
+    if not callable(source):
+        values = np.asarray(source, dtype=float)
+        if values.shape != (nt,):
+            raise ValueError("source array of shape %s does not match the %d time steps" % (values.shape, nt))
+        return values
+    if source is simple_sin_source:
+        return simple_sin_source_array(nt)
+    return np.fromiter((source(t) for t in range(nt)), dtype=float, count=nt)
@@ -1,5 +1,3 @@
-import timeit
-
 import common
 import callers
 import source as src
@@ -38,9 +36,9 @@ def comparison_test(params):
     history_bpml = callers.call_bpml(nx, ny, nt, dx, dy, dt, p, pmlc, source)
     history_cpml = callers.call_cpml(nx, ny, nt, dx, dy, dt, p, pmlc, source)
 
-    ny = int(params[1] / 2)
-    b_snap = history_bpml[:, ny, -1]
-    c_snap = history_cpml[:, ny, -1]
+    ny = params[1] // 2
+    b_snap = history_bpml[-1, :, ny]
+    c_snap = history_cpml[-1, :, ny]
 
     names = ["BPML", "CPML"]
     labels = ["Space [Cells]", "Hz [V/m]"]
@@ -63,10 +61,10 @@ def pml_test(params, pml):
     big_nx = nx * 3
     big_ny = ny * 3
 
-    s_nx_h = int(nx / 2)
-    b_nx_h = int(big_nx / 2)
-    b_ny_t1 = int(big_ny / 3)
-    b_ny_t2 = int(2 * big_ny / 3)
+    s_nx_h = nx // 2
+    b_nx_h = big_nx // 2
+    b_ny_t1 = big_ny // 3
+    b_ny_t2 = 2 * big_ny // 3
 
     big_p = (p[0] * 3, p[1] * 3)
 
@@ -75,15 +73,15 @@ def pml_test(params, pml):
             return callers.call_cpml(mx, my, nt, dx, dy, dt, q, pmlc, source)
     elif pml == "bpml":
         def thing(mx, my, q):
-            return callers.call_bpml(mx, my, nt, dx, dy, dt, q, pmlc, 0, source)
+            return callers.call_bpml(mx, my, nt, dx, dy, dt, q, pmlc, source, 0)
     else:
         print("This function needs to be called with an argument specifying the PML implementation.")
 
     small_history = thing(nx, ny, p)
     big_history = thing(big_nx, big_ny, big_p)
 
-    small_snap = small_history[s_nx_h, :, -1]
-    big_snap = big_history[b_nx_h, b_ny_t1:b_ny_t2, -1]
+    small_snap = small_history[-1, s_nx_h, :]
+    big_snap = big_history[-1, b_nx_h, b_ny_t1:b_ny_t2]
 
     snaps = [small_snap, big_snap]
     labels = ["Space [Cells]", "Hz [V/m]"]
@@ -101,20 +99,21 @@ def time_test(params, rep=100, num=1):
     :param rep: int
     :param num: int
     """
-    nx, ny, lx, ly, dx, dy, dt, t, p, pmlc = params
+    nx, ny, lx, ly, dx, dy, dt, t, p, pmlc, source = params
 
+    # only the computation is timed, so no history is recorded
     def berengercaller():
-        callers.call_bpml(nx, ny, t, dx, dy, dt, p, pmlc)
+        callers.call_bpml(nx, ny, t, dx, dy, dt, p, pmlc, source, record=False)
 
     def cpmlcaller():
-        callers.call_cpml(nx, ny, t, dx, dy, dt, p, pmlc)
+        callers.call_cpml(nx, ny, t, dx, dy, dt, p, pmlc, source, record=False)
 
     def nopmlcaller():
-        callers.call_npml(nx, ny, t, dx, dy, dt, p)
+        callers.call_npml(nx, ny, t, dx, dy, dt, p, source, record=False)
 
-    npml_times = timeit.repeat(nopmlcaller, repeat=rep, number=num)
-    bpml_times = timeit.repeat(berengercaller, repeat=rep, number=num)
-    cpml_times = timeit.repeat(cpmlcaller, repeat=rep, number=num)
+    npml_times = common.bench(nopmlcaller, rep, num)
+    bpml_times = common.bench(berengercaller, rep, num)
+    cpml_times = common.bench(cpmlcaller, rep, num)
 
     names = ["noPML", "BPML", "CPML"]
     results = common.compare([npml_times, bpml_times, cpml_times])
@@ -140,8 +139,8 @@ def time_trivial(params, rep=100, num=1):
     def nopmlcaller():
         callers.call_npml(nx, ny, nt, dx, dy, dt, p, source)
 
-    trivial_times = timeit.repeat(trivial_caller, number=num, repeat=rep)
-    nopml_times = timeit.repeat(nopmlcaller, number=num, repeat=rep)
+    trivial_times = common.bench(trivial_caller, rep, num)
+    nopml_times = common.bench(nopmlcaller, rep, num)
 
     names = ["trivial", "nopml"]
     results = common.compare([trivial_times, nopml_times])
@@ -158,12 +157,12 @@ def loss_test(params):
     """
     nx, ny, lx, ly, dx, dy, dt, t, p, pmlc, source = params
 
-    history1 = callers.call_bpml(nx, ny, t, dx, dy, dt, p, pmlc, 0.1, source)
-    history2 = callers.call_bpml(nx, ny, t, dx, dy, dt, p, pmlc, 0.01, source)
-    history3 = callers.call_bpml(nx, ny, t, dx, dy, dt, p, pmlc, 0.001, source)
+    history1 = callers.call_bpml(nx, ny, t, dx, dy, dt, p, pmlc, source, 0.1)
+    history2 = callers.call_bpml(nx, ny, t, dx, dy, dt, p, pmlc, source, 0.01)
+    history3 = callers.call_bpml(nx, ny, t, dx, dy, dt, p, pmlc, source, 0.001)
 
-    nyh = int(ny / 2)
+    nyh = ny // 2
     names = ["sigma = 0", "sigma = 0.01", "sigma = 0.001"]
     labels = ["Hz [V/m]", "Space / [Cells]"]
-    snaps = [history1[:, nyh, 50], history2[:, nyh, 50], history3[:, nyh, 50]]
+    snaps = [history1[50, :, nyh], history2[50, :, nyh], history3[50, :, nyh]]
     common.plot_snaps(names, labels, snaps)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# the modules in src import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import cpml  # noqa: E402
+import no_pml  # noqa: E402
+
+
+@pytest.fixture
+def wavefront(monkeypatch):
+    # force the wavefront kernels, which only inject the source and read the probes when they reach their rows
+    monkeypatch.setattr(no_pml, "get_num_threads", lambda: 1)
+    monkeypatch.setattr(no_pml, "WAVEFRONT_CELLS", 0)
+    monkeypatch.setattr(cpml, "get_num_threads", lambda: 1)
@@ -0,0 +1,50 @@
+import math
+
+import numpy as np
+import pytest
+import scipy.constants as const
+
+import bpml
+import callers
+import source as src
+from jit import NUMBA
+
+NX, NY, NT = 120, 100, 60
+DX, DY = 0.04, 0.05
+DT = (const.c * math.sqrt(DX ** -2 + DY ** -2)) ** -1
+
+kernels = pytest.mark.skipif(not NUMBA, reason="the kernels are compiled with numba")
+
+
+def run(monkeypatch, uniform_fraction, numba=True):
+    # a fraction of 0 always selects "_bpml_step_uniform", one above 1 always "_bpml_step"
+    monkeypatch.setattr(bpml, "UNIFORM_FRACTION", uniform_fraction)
+    monkeypatch.setattr(bpml, "NUMBA", numba)
+    return callers.call_bpml(NX, NY, NT, DX, DY, DT, (60, 50), (10, 1e-6, 3), src.simple_sin_source, s=0.01)
+
+
+def test_some_rows_have_no_uniform_run(monkeypatch):
+    found = []
+    uniform_runs = bpml.uniform_runs
+    monkeypatch.setattr(bpml, "uniform_runs", lambda constants: found.append(uniform_runs(constants)) or found[-1])
+    monkeypatch.setattr(bpml, "NUMBA", True)
+    monkeypatch.setattr(bpml, "_bpml_step", lambda *args: None)
+    callers.call_bpml(NX, NY, 1, DX, DY, DT, (60, 50), (10, 1e-6, 3), src.simple_sin_source, s=0.01)
+    runs, _ = found[0]
+    lengths = runs[:, 1].astype(int) - runs[:, 0].astype(int)
+    # the rows inside the PML along x differ from the center everywhere
+    assert np.any(lengths == 0) and np.any(lengths > 0)
+
+
+@kernels
+def test_uniform_kernel_matches_general_kernel(monkeypatch):
+    np.testing.assert_array_equal(run(monkeypatch, 0), run(monkeypatch, 2))
+
+
+@kernels
+@pytest.mark.parametrize("uniform_fraction", [0, 2])
+def test_kernels_match_numpy_step(monkeypatch, uniform_fraction):
+    expected = run(monkeypatch, 2, numba=False)
+    assert np.abs(expected).max() > 0
+    np.testing.assert_allclose(run(monkeypatch, uniform_fraction), expected, rtol=0,
+                               atol=1e-5 * np.abs(expected).max())
@@ -0,0 +1,16 @@
+import pytest
+
+import callers
+import source as src
+
+
+@pytest.mark.parametrize("call", [
+    lambda: callers.call_npml(60, 60, 5, 0.05, 0.05, 1e-10, (10, 10), src.simple_sin_source, backend="cuda"),
+    lambda: callers.call_bpml(100, 100, 5, 0.05, 0.05, 1e-10, (10, 10), (10, 1e-6, 3), src.simple_sin_source,
+                              backend="cuda"),
+    lambda: callers.call_cpml(100, 100, 5, 0.05, 0.05, 1e-10, (10, 10), (10, 1e-6, 3), src.simple_sin_source,
+                              backend="cuda"),
+], ids=["npml", "bpml", "cpml"])
+def test_unknown_backend_raises(call):
+    with pytest.raises(ValueError):
+        call()
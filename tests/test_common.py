@@ -0,0 +1,14 @@
+import numpy as np
+import pytest
+
+import common
+
+
+def test_modes_match_numpy():
+    data = np.random.default_rng(0).standard_normal((30, 20, 10)).astype(common.DTYPE)
+    np.testing.assert_allclose(common.get_modes(data), [data.min(), data.mean(), data.std()], rtol=1e-5)
+
+
+def test_modes_of_empty_data_raise():
+    with pytest.raises(ValueError):
+        common.get_modes(np.empty((0, 5), dtype=common.DTYPE))
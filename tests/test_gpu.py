@@ -0,0 +1,28 @@
+import math
+
+import numpy as np
+import pytest
+import scipy.constants as const
+
+pytest.importorskip("cupy")
+
+import callers
+import source as src
+
+NX, NY, NT = 100, 100, 70  # more time steps than one block of gpu.run, so the double buffering is exercised
+DX = DY = 0.05
+DT = (const.c * math.sqrt(DX ** -2 + DY ** -2)) ** -1
+P = (50, 50)
+PMLC = (10, 1e-6, 3)
+
+
+@pytest.mark.parametrize("call", [
+    lambda **k: callers.call_npml(NX, NY, NT, DX, DY, DT, P, src.simple_sin_source, **k),
+    lambda **k: callers.call_bpml(NX, NY, NT, DX, DY, DT, P, PMLC, src.simple_sin_source, **k),
+    lambda **k: callers.call_cpml(NX, NY, NT, DX, DY, DT, P, PMLC, src.simple_sin_source, **k),
+], ids=["npml", "bpml", "cpml"])
+def test_gpu_matches_cpu(call):
+    cpu = call()
+    gpu = call(backend="gpu")
+    assert gpu.shape == cpu.shape
+    np.testing.assert_allclose(gpu, cpu, rtol=0, atol=1e-4 * np.abs(cpu).max())
@@ -0,0 +1,13 @@
+import ctypes
+
+import numpy as np
+
+import jit
+
+
+def test_unloadable_library_is_skipped(tmp_path, monkeypatch):
+    # load_c_function looks for the libraries next to jit.py
+    monkeypatch.setattr(jit, "__file__", str(tmp_path / "jit.py"))
+    (tmp_path / "libbroken.so").write_bytes(b"not a shared library")
+    assert jit.load_c_function("libbroken.so", "evolve", [ctypes.c_int], np.float32) is None
+    assert jit.load_c_function("libmissing.so", "evolve", [ctypes.c_int], np.float32) is None
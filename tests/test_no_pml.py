@@ -0,0 +1,63 @@
+import math
+
+import numpy as np
+import pytest
+import scipy.constants as const
+
+import common
+import no_pml
+import source as src
+
+NX, NY, NT = 14, 11, 12
+D = 0.05
+DT = (const.c * math.sqrt(2 * D ** -2)) ** -1
+SOURCEPOINT = (5, 4)
+
+
+def reference_evolution(nt, fields, constants, history, sourcepoint, source_vals):
+    """
+    Serial loop form of the update equations of "no_pml.evolution", in the same order: hz first, then the source,
+    then ex and ey.
+    """
+    ex, ey, hz = fields
+    cex, cey, chzx, chzy = constants
+    nx, ny = hz.shape
+    for t in range(nt):
+        for i in range(nx):
+            for j in range(ny):
+                hz[i, j] += -chzx * (ey[i + 1, j] - ey[i, j]) + chzy * (ex[i, j + 1] - ex[i, j])
+        hz[sourcepoint] = source_vals[t]
+        for i in range(nx):
+            for j in range(1, ny):
+                ex[i, j] += cex * (hz[i, j] - hz[i, j - 1])
+        for i in range(1, nx):
+            for j in range(ny):
+                ey[i, j] -= cey * (hz[i, j] - hz[i - 1, j])
+        history[t] = hz
+    return history
+
+
+def run(evolve):
+    fields = common.make_fields(NX, NY)
+    constants = no_pml.calculate_constants(D, D, DT)
+    history = common.make_history(NX, NY, NT)
+    return evolve(NT, fields, constants, history, SOURCEPOINT, src.simple_sin_source_array(NT))
+
+
+def assert_matches_reference(history):
+    expected = run(reference_evolution)
+    np.testing.assert_allclose(history, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+
+
+def test_kernel_matches_reference():
+    assert_matches_reference(run(no_pml.evolution))
+
+
+def test_wavefront_matches_reference(wavefront):
+    assert_matches_reference(run(no_pml.evolution))
+
+
+def test_numpy_step_matches_reference(monkeypatch):
+    monkeypatch.setattr(no_pml, "NUMBA", False)
+    monkeypatch.setattr(no_pml, "_c_evolve", None)
+    assert_matches_reference(run(no_pml.evolution))
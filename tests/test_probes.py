@@ -0,0 +1,48 @@
+import math
+
+import numpy as np
+import pytest
+import scipy.constants as const
+
+import callers
+import cpml
+import no_pml
+import source as src
+
+N, NT = 100, 20
+D = 0.05
+DT = (const.c * math.sqrt(2 * D ** -2)) ** -1
+PROBES = [(22, 22), (-80, -78), (25, -3), (-1, 0)]
+
+
+@pytest.fixture
+def numpy_step(monkeypatch):
+    # force the array implementations of the time steps
+    monkeypatch.setattr(no_pml, "NUMBA", False)
+    monkeypatch.setattr(no_pml, "_c_evolve", None)
+    monkeypatch.setattr(cpml, "NUMBA", False)
+    monkeypatch.setattr(cpml, "_c_step", None)
+
+
+def probe_npml(points):
+    return callers.call_npml(N, N, NT, D, D, DT, (20, 20), src.simple_sin_source, probe_points=points)
+
+
+def probe_cpml(points):
+    return callers.call_cpml(N, N, NT, D, D, DT, (20, 20), (10, 1e-6, 3), src.simple_sin_source,
+                             probe_points=points)
+
+
+@pytest.mark.parametrize("probe", [probe_npml, probe_cpml])
+def test_wavefront_probes_match_numpy(probe, wavefront, request):
+    probes = probe(PROBES)
+    request.getfixturevalue("numpy_step")
+    expected = probe(PROBES)
+    assert np.all(np.abs(expected[:2]).max(axis=1) > 0)
+    np.testing.assert_allclose(probes, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize("probe", [probe_npml, probe_cpml])
+def test_probe_outside_raises(probe):
+    with pytest.raises(ValueError):
+        probe([(0, 0), (N, 0)])
@@ -0,0 +1,64 @@
+import math
+
+import numpy as np
+import pytest
+import scipy.constants as const
+
+import callers
+import common
+import no_pml
+import source as src
+
+N, NT = 60, 20
+D = 0.05
+DT = (const.c * math.sqrt(2 * D ** -2)) ** -1
+
+
+def run_npml(sourcepoint):
+    fields = common.make_fields(N, N)
+    constants = no_pml.calculate_constants(D, D, DT)
+    return no_pml.evolution(NT, fields, constants, None, sourcepoint, src.simple_sin_source_array(NT))
+
+
+def test_grid_index_wraps_negative_indices():
+    assert common.grid_index((-1, -10), (60, 50)) == (59, 40)
+    assert common.grid_index((3, 4), (60, 50)) == (3, 4)
+
+
+@pytest.mark.parametrize("point", [(60, 0), (0, 50), (-61, 0), (0, -51)])
+def test_grid_index_rejects_points_outside(point):
+    with pytest.raises(ValueError):
+        common.grid_index(point, (60, 50))
+
+
+def test_negative_sourcepoint_in_wavefront(wavefront):
+    np.testing.assert_array_equal(run_npml((-10, -10)), run_npml((N - 10, N - 10)))
+    assert run_npml((-10, -10))[N - 10, N - 10] == np.float32(np.sin((NT - 1) / 5))
+
+
+def test_sourcepoint_outside_raises(wavefront):
+    with pytest.raises(ValueError):
+        run_npml((N, 0))
+
+
+def test_negative_sourcepoint_in_cpml_wavefront(wavefront):
+    dt = (const.c * math.sqrt(2 * D ** -2)) ** -1
+
+    def run(sourcepoint):
+        return callers.call_cpml(100, 100, NT, D, D, dt, sourcepoint, (10, 1e-6, 3), src.simple_sin_source,
+                                 record=False)
+
+    np.testing.assert_array_equal(run((-10, -10)), run((90, 90)))
+
+
+@pytest.mark.parametrize("values", [np.ones(NT - 1), np.ones((NT, 1))])
+def test_source_array_of_wrong_shape_raises(values):
+    with pytest.raises(ValueError):
+        src.source_values(values, NT)
+    with pytest.raises(ValueError):
+        callers.call_npml(N, N, NT, D, D, DT, (10, 10), values)
+
+
+def test_source_array_is_used_as_is():
+    values = np.linspace(0, 1, NT)
+    np.testing.assert_array_equal(src.source_values(values, NT), values)